@@ -0,0 +1,227 @@
+import os
+import sys
+import io
+import json
+import time
+import zlib
+import argparse
+import platform
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import simplepng
+
+bench_dir = os.path.dirname(__file__)
+default_baseline_path = os.path.join(bench_dir, "baseline.json")
+default_sizes = [64, 256, 1024]
+
+def main():
+  parser = argparse.ArgumentParser(description="times simplepng on synthetic images.")
+  parser.add_argument("--sizes", default=",".join(str(size) for size in default_sizes),
+      help="comma separated widths of the square test images. default: %(default)s")
+  parser.add_argument("--repeat", type=int, default=3,
+      help="run each benchmark this many times and keep the fastest. default: %(default)s")
+  parser.add_argument("--filter", default="",
+      help="only run benchmarks whose name contains this string")
+  parser.add_argument("--no-numpy", action="store_true",
+      help="benchmark the pure python code paths")
+  parser.add_argument("--baseline", default=default_baseline_path,
+      help="compare against this json file of results, if it exists. default: %(default)s")
+  parser.add_argument("--save", action="store_true",
+      help="write the results to the baseline file instead of comparing against it")
+  parser.add_argument("--tolerance", type=float, default=0.1,
+      help="report benchmarks that are this fraction slower than the baseline. default: %(default)s")
+  args = parser.parse_args()
+  if args.no_numpy:
+    simplepng.numpy = None
+  sizes = [int(size) for size in args.sizes.split(",")]
+
+  results = {}
+  for name, pixel_count, output_size, run in iter_benchmarks(sizes):
+    if args.filter not in name: continue
+    seconds = min(time_once(run) for _ in range(args.repeat))
+    # tracemalloc slows everything down, so it gets its own run
+    tracemalloc.start()
+    try:
+      run()
+      _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    result = {
+      "seconds": seconds,
+      "megapixels_per_second": pixel_count / 1e6 / seconds,
+      "peak_bytes": peak_bytes,
+    }
+    if output_size != None:
+      # compared to 8-bit RGBA
+      result["compressed_ratio"] = output_size / (pixel_count * 4)
+    results[name] = result
+    print(format_result(name, result))
+    sys.stdout.flush()
+
+  report = {
+    "python": platform.python_version(),
+    "numpy": simplepng.numpy != None,
+    "results": results,
+  }
+  if args.save:
+    with open(args.baseline, "w") as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+      f.write("\n")
+    print("saved: " + args.baseline)
+  elif os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    if compare(report, baseline, args.tolerance) != 0:
+      sys.exit(1)
+
+def time_once(run):
+  start_time = time.perf_counter()
+  run()
+  return time.perf_counter() - start_time
+
+def format_result(name, result):
+  line = "{:<56} {:>9.3f} MP/s {:>9.1f} ms {:>9.1f} MiB peak".format(
+      name, result["megapixels_per_second"], result["seconds"] * 1000, result["peak_bytes"] / 0x100000)
+  if "compressed_ratio" in result:
+    line += " {:>7.3f} ratio".format(result["compressed_ratio"])
+  return line
+
+def compare(report, baseline, tolerance):
+  # returns the number of regressions
+  if report["numpy"] != baseline["numpy"]:
+    print("WARNING: the baseline was run with numpy={}".format(baseline["numpy"]))
+  regressions = 0
+  print("")
+  print("compared to the baseline:")
+  for name, result in report["results"].items():
+    if name not in baseline["results"]: continue
+    speedup = result["megapixels_per_second"] / baseline["results"][name]["megapixels_per_second"]
+    marker = ""
+    if speedup < 1 - tolerance:
+      marker = "  REGRESSION"
+      regressions += 1
+    print("{:<56} {:>6.2f}x{}".format(name, speedup, marker))
+  print("{} regressions".format(regressions))
+  return regressions
+
+def iter_benchmarks(sizes):
+  # yields (name, pixel_count, output_size or None, run) for every benchmark
+  for size in sizes:
+    pixel_count = size * size
+    for color_type, bit_depths in sorted(simplepng.readable_bit_depths.items()):
+      for bit_depth in bit_depths:
+        for interlaced in (0, 1):
+          data = make_png(size, size, color_type, bit_depth, interlaced)
+          name = "read_png {0}x{0} color_type={1} bit_depth={2}{3}".format(
+              size, color_type, bit_depth, " interlaced" if interlaced else "")
+          yield name, pixel_count, len(data), lambda data=data: simplepng.read_png(data)
+
+    image = make_image(size, size)
+    gray_image = make_image(size, size, gray=True)
+    for label, source in [("rgba", image), ("gray", gray_image)]:
+      for options in [{"filter_strategy": 1}, {"filter_strategy": "adaptive"}, {"preset": "fast"}]:
+        name = "write_png {0}x{0} {1} {2}".format(size, label, " ".join("{}={}".format(*item) for item in options.items()))
+        output = io.BytesIO()
+        simplepng.write_png(output, source, **options)
+        def run(source=source, options=options):
+          simplepng.write_png(io.BytesIO(), source, **options)
+        yield name, pixel_count, len(output.getvalue()), run
+
+    sprite = make_image(size // 2, size // 2, translucent=True)
+    def run_paste(image=image, sprite=sprite):
+      image.copy().paste(sprite, dx=image.width // 4, dy=image.height // 4)
+    yield "paste {0}x{0} onto {1}x{1}".format(size // 2, size), (size // 2) ** 2, None, run_paste
+    # every pair of alphas, which the opaque background above never gets to
+    translucent_image = make_image(size, size, translucent=True)
+    def run_paste_translucent(image=translucent_image, sprite=sprite):
+      image.copy().paste(sprite, dx=image.width // 4, dy=image.height // 4)
+    yield "paste {0}x{0} onto translucent {1}x{1}".format(size // 2, size), (size // 2) ** 2, None, run_paste_translucent
+    yield "copy {0}x{0}".format(size), pixel_count, None, image.copy
+    yield "flip_h {0}x{0}".format(size), pixel_count, None, image.flip_h
+    yield "rotate {0}x{0}".format(size), pixel_count, None, lambda image=image: image.rotate(1)
+    # a tile renderer's operations, on a quarter of the image
+    quarter = (size // 4, size // 4, size // 2, size // 2)
+    yield "fill {0}x{0} of {1}x{1}".format(size // 2, size), (size // 2) ** 2, None, lambda image=image: image.fill(quarter, 0x112233ff)
+    def run_blit(image=image, sprite=sprite):
+      image.blit(sprite, dx=image.width // 4, dy=image.height // 4)
+    yield "blit {0}x{0} onto {1}x{1}".format(size // 2, size), (size // 2) ** 2, None, run_blit
+    yield "scroll {0}x{0}".format(size), pixel_count, None, lambda image=image: image.scroll(3, 5)
+    # a stack of layers that each cover the left half of the ones below, where flatten() skips the covered parts
+    layers = [make_image(size, size, opaque_left=True) for _ in range(8)]
+    def run_flatten(layers=layers, size=size):
+      simplepng.flatten([(layer, (0, 0), False, 0) for layer in layers], canvas_size=(size, size))
+    def run_paste_layers(layers=layers, size=size):
+      canvas = simplepng.ImageBuffer(size, size)
+      for layer in layers:
+        canvas.paste(layer)
+    yield "flatten 8 half opaque layers {0}x{0}".format(size), 8 * pixel_count, None, run_flatten
+    # nothing gets covered, so every layer is blended
+    translucent_layers = [make_image(size, size, translucent=True) for _ in range(4)]
+    def run_flatten_translucent(layers=translucent_layers, background=translucent_image):
+      simplepng.flatten([(layer, (0, 0), False, 0) for layer in layers], background=background)
+    yield "flatten 4 translucent layers onto translucent {0}x{0}".format(size), 4 * pixel_count, None, run_flatten_translucent
+    yield "paste 8 half opaque layers {0}x{0}".format(size), 8 * pixel_count, None, run_paste_layers
+
+def make_image(width, height, gray=False, translucent=False, opaque_left=False):
+  # smooth gradients with some noise, so that compression has something to find but not too much
+  image = simplepng.ImageBuffer(width, height)
+  noise = pattern_bytes(width * height, 0)
+  values = []
+  for y in range(height):
+    for x in range(width):
+      n = noise[y * width + x] & 0x0f
+      r = (x * 255 // width + n) & 0xff
+      if gray:
+        values.append((r * 0x01010100) | 0xff)
+        continue
+      g = (y * 255 // height + n) & 0xff
+      b = ((x + y) * 127 // width) & 0xff
+      if opaque_left:
+        # opaque on the left half and transparent on the right
+        a = 0xff if x < width // 2 else 0
+      else:
+        a = ((x ^ y) & 0xff) if translucent else 0xff
+      values.append((r << 24) | (g << 16) | (b << 8) | a)
+  image.data[:] = simplepng.array(simplepng.pixel_typecode, values)
+  return image
+
+def pattern_bytes(length, seed):
+  # cheap deterministic noise
+  out = bytearray(length)
+  state = seed * 2654435761 + 1
+  for i in range(length):
+    state = (state * 1103515245 + 12345) & 0x7fffffff
+    out[i] = state >> 23
+  return out
+
+def make_png(width, height, color_type, bit_depth, interlaced):
+  # writes a png of any color type, bit depth and interlacing directly,
+  # since write_png() only writes non-interlaced images of up to 8 bits per sample.
+  bits_per_pixel = simplepng.channel_counts[color_type] * bit_depth
+  interlacing = simplepng.adam7_interlacing if interlaced else simplepng.no_interlacing
+  raw = bytearray()
+  for pass_index, (x_scale, x_offset, y_scale, y_offset) in enumerate(interlacing):
+    pass_width = (width + x_scale - x_offset - 1) // x_scale
+    pass_height = (height + y_scale - y_offset - 1) // y_scale
+    if pass_width == 0: continue
+    scanline_length = (pass_width * bits_per_pixel + 7) // 8
+    noise = pattern_bytes(scanline_length * pass_height, pass_index)
+    for y in range(pass_height):
+      # a gradient with noise in the low bits, sent with filter type 0.
+      # every sample is a valid palette index, because the palette has 2**bit_depth entries.
+      raw.append(0)
+      row_y = y * y_scale + y_offset
+      raw += bytes((i + row_y + (noise[y * scanline_length + i] & 0x07)) & 0xff for i in range(scanline_length))
+  out = io.BytesIO()
+  out.write(simplepng.magic_number)
+  simplepng.Chunk(b"IHDR", simplepng.struct.pack(simplepng.IHDR_fmt, width, height, bit_depth, color_type, 0, 0, interlaced)).write_to(out)
+  if color_type == 3:
+    palette_size = 1 << bit_depth
+    simplepng.Chunk(b"PLTE", bytes((i * 255 // (palette_size - 1) + c * 85) & 0xff for i in range(palette_size) for c in range(3))).write_to(out)
+  simplepng.Chunk(b"IDAT", zlib.compress(bytes(raw))).write_to(out)
+  simplepng.Chunk(b"IEND", b"").write_to(out)
+  return out.getvalue()
+
+if __name__ == "__main__":
+  main()
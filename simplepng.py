@@ -1,12 +1,31 @@
 # this is python 3, not python 2
 
-__all__ = ["read_png", "write_png", "ImageBuffer", "SimplePngError"]
+__all__ = ["read_png", "read_png_async", "read_png_info", "PngCache", "iter_png_rows", "write_png", "write_png_async", "PngWriter", "IncrementalPngEncoder", "PngStats", "flatten", "ImageBuffer", "SimplePngError"]
 
 import struct
 import zlib
 import sys
+import os
+import io
+import shlex
+import re
 import time
 import collections
+import contextlib
+import operator
+import hashlib
+import threading
+import queue
+import asyncio
+import mmap
+import concurrent.futures
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  # everything works without numpy, just slower
+  numpy = None
 
 # adapted from http://stackoverflow.com/a/25835368/367916
 
@@ -17,43 +36,676 @@ color_type_mask_INDEXED = 1
 color_type_mask_COLOR = 2
 color_type_mask_ALPHA = 4
 
+# an array typecode for unsigned 32-bit pixel values
+pixel_typecode = "I" if array("I").itemsize == 4 else "L"
+
 def I4(value):
   return struct.pack("!I", value)
 
-def write_png(f, image):
-  height = image.height
+def write_png(f, image, filter_strategy=None, verbose=False, optimize_color_type=True, threads=1, stats=None, **compression_options):
+  # with optimize_color_type, the image is scanned first to find the smallest lossless color type and bit depth.
+  # otherwise, the image is written as 8-bit RGBA.
+  # stats is a PngStats to record where the time goes.
+  # compression_options are preset, compression_level, compression_strategy, mem_level, window_bits and chunk_size,
+  # as for PngWriter.
+  if image.width * image.height == 0:
+    # the same check as PngWriter's, before scanning
+    raise SimplePngError("image must have > 0 pixels")
+  if stats != None: start = time.perf_counter()
+  png_format = choose_png_format(image) if optimize_color_type else {}
+  if stats != None: stats.add_time("choose_format", start)
+  writer = PngWriter(f, image.width, image.height, filter_strategy=filter_strategy, verbose=verbose, threads=threads, stats=stats,
+      **png_format, **compression_options)
+  writer.write_rows(image.rows())
+  writer.close()
+
+async def write_png_async(writer, image, executor=None, **options):
+  # writer is an asyncio.StreamWriter, or anything with write() and an async drain().
+  # the image is encoded by write_png() in executor, a thread pool, or the event loop's default executor,
+  # and each chunk is written to writer as soon as it's ready. options are passed to write_png().
+  loop = asyncio.get_running_loop()
+  sink = StreamSink(loop)
+  def encode():
+    try:
+      write_png(sink, image, **options)
+    finally:
+      loop.call_soon_threadsafe(sink.pieces.put_nowait, None)
+  encoding = loop.run_in_executor(executor, encode)
+  try:
+    while True:
+      piece = await sink.pieces.get()
+      if piece == None:
+        break
+      writer.write(piece)
+      sink.slots.release()
+      await writer.drain()
+    await encoding
+  finally:
+    # lets the encoder stop if we're interrupted
+    sink.closed = True
+    sink.slots.release()
+    if not encoding.done():
+      encoding.cancel()
+    elif not encoding.cancelled():
+      # marks any error as retrieved, since we're already raising something else
+      encoding.exception()
+
+# opaque colors that are unlikely to be in an image, to write transparent pixels as with tRNS
+transparent_color_candidates = [0x000000ff, 0xff00ffff, 0x00ff01ff, 0x010203ff, 0xfefdfcff]
+
+def choose_png_format(image):
+  # returns keyword arguments for PngWriter for the smallest color type and bit depth
+  # that can represent every pixel in the image exactly.
   width = image.width
+  colors = set()
+  gray_values = set()
+  opaque = True
+  gray = True
+  # whether every non-opaque pixel is 0, which is how this library decodes a tRNS color match
+  binary_alpha = True
+  key_candidates = list(transparent_color_candidates)
+  for row in image.rows():
+    values = pixels_to_array(row)
+    if colors != None:
+      colors.update(values)
+      if len(colors) > 0x100:
+        colors = None
+    rgba = pixels_to_bytes(values)
+    alpha = rgba[3::4]
+    opaque_count = alpha.count(0xff)
+    if opaque_count != width:
+      opaque = False
+      if values.count(0) != width - opaque_count:
+        binary_alpha = False
+    if gray:
+      red = rgba[0::4]
+      if red != rgba[1::4] or red != rgba[2::4]:
+        gray = False
+      elif opaque_count == width:
+        gray_values.update(red)
+      else:
+        gray_values.update(r for r, a in zip(red, alpha) if a == 0xff)
+    if binary_alpha:
+      key_candidates = [key for key in key_candidates if key not in values]
 
-  f.write(magic_number)
+  # (bits_per_pixel, format), in order of preference for the same size.
+  # the size of the palette is accounted for in bits per pixel of the whole image.
+  options = []
+  if gray and (opaque or binary_alpha):
+    for bit_depth in (1, 2, 4, 8):
+      scale = 0xff // ((1 << bit_depth) - 1)
+      if any(value % scale != 0 for value in gray_values): continue
+      transparent_color = None
+      if not opaque:
+        samples = {value // scale for value in gray_values}
+        unused_samples = [sample for sample in range(1 << bit_depth) if sample not in samples]
+        if len(unused_samples) == 0: continue
+        transparent_color = (unused_samples[0] * scale * 0x01010100) | 0xff
+      options.append((bit_depth, {"color_type": 0, "bit_depth": bit_depth, "transparent_color": transparent_color}))
+      break
+  if gray and not opaque:
+    options.append((16, {"color_type": color_type_mask_ALPHA, "bit_depth": 8}))
+  if opaque:
+    options.append((24, {"color_type": color_type_mask_COLOR, "bit_depth": 8}))
+  elif binary_alpha and len(key_candidates) > 0:
+    options.append((24, {"color_type": color_type_mask_COLOR, "bit_depth": 8, "transparent_color": key_candidates[0]}))
+  if colors != None:
+    # put the translucent colors first to make the tRNS chunk short
+    palette = sorted(colors, key=lambda value: (value & 0xff == 0xff, value))
+    bit_depth = min(bit_depth for bit_depth in (1, 2, 4, 8) if len(palette) <= 1 << bit_depth)
+    palette_bits = 8 * 4 * len(palette) / (width * image.height)
+    options.append((bit_depth + palette_bits, {"color_type": color_type_mask_INDEXED | color_type_mask_COLOR, "bit_depth": bit_depth, "palette": palette}))
+  options.append((32, {"color_type": color_type_mask_COLOR | color_type_mask_ALPHA, "bit_depth": 8}))
+  return min(options, key=lambda option: option[0])[1]
 
-  # IHDR
-  color_type = color_type_mask_COLOR | color_type_mask_ALPHA
-  bit_depth = 8
-  compression = 0
-  filter_method = 0
-  interlaced = 0
-  IHDR = struct.pack(IHDR_fmt, width, height, bit_depth, color_type, compression, filter_method, interlaced)
-  Chunk(b"IHDR", IHDR).write_to(f)
+writable_bit_depths = {
+  0: (1, 2, 4, 8),
+  2: (8,),
+  3: (1, 2, 4, 8),
+  4: (8,),
+  6: (8,),
+}
 
-  # IDAT
-  raw = []
-  for y in range(height):
-    raw.append(b"\x01") # filter type is difference from previous value
-    previous_value = 0
-    for x in range(width):
-      value = image.data[y * width + x]
-      raw.append(I4(subtract_bytes(value, previous_value)))
-      previous_value = value
-  raw = b"".join(raw)
-  compressor = zlib.compressobj()
-  compressed = compressor.compress(raw)
-  compressed += compressor.flush()
-  block = b"IDAT" + compressed
-  f.write(I4(len(compressed)) + block + I4(zlib.crc32(block)))
-
-  # IEND
-  block = b"IEND"
-  f.write(I4(0) + block + I4(zlib.crc32(block)))
+idat_chunk_size = 0x10000
+# how much filtered data each thread compresses at a time
+parallel_block_size = 0x20000
+# PngWriter options for common trade-offs between speed and size
+compression_presets = {
+  # for previews
+  "fast": {"filter_strategy": 1, "compression_level": 1},
+  # the defaults
+  "balanced": {},
+  # for archiving. much slower.
+  "smallest": {"filter_strategy": "brute", "compression_level": 9, "mem_level": 9},
+}
+compression_strategies = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_HUFFMAN_ONLY, zlib.Z_RLE, zlib.Z_FIXED)
+default_compression_options = {
+  "filter_strategy": 1,
+  "compression_level": zlib.Z_DEFAULT_COMPRESSION,
+  "compression_strategy": zlib.Z_DEFAULT_STRATEGY,
+  "mem_level": 8,
+  "window_bits": zlib.MAX_WBITS,
+  "chunk_size": idat_chunk_size,
+}
+
+class PngWriter:
+  # encodes a png image one row at a time, writing IDAT chunks as the compressed data accumulates.
+  # filter_strategy is a filter type 0-4 to use for every scanline,
+  # "adaptive" to pick the filter type with the smallest sum of absolute differences for each scanline,
+  # or "brute" to pick the filter type that compresses smallest for each scanline.
+  # color_type and bit_depth default to 8-bit RGBA. every pixel written must be representable in them.
+  # palette is a list of 0xRRGGBBAA values for indexed color.
+  # for grayscale or RGB, transparent_color is an opaque 0xRRGGBBAA value that transparent pixels
+  # (pixels with the value 0) are written as, and which is marked transparent with a tRNS chunk.
+  # with threads > 1, the filtered data is split into blocks that are compressed in parallel
+  # and stitched back together into one zlib stream.
+  # stats is a PngStats to record where the time goes.
+  # compression_level (0-9, or -1 for zlib's default), compression_strategy (zlib.Z_FILTERED, zlib.Z_RLE, etc.),
+  # mem_level (1-9) and window_bits (9-15) are passed to zlib.compressobj().
+  # chunk_size is the most compressed data to put in each IDAT chunk.
+  # preset is "fast", "balanced" or "smallest" to set filter_strategy and the compression options at once.
+  # options given explicitly override the preset. with threads > 1, "smallest" filters with "adaptive" instead of "brute".
+  def __init__(self, f, width, height, chunk_size=None, filter_strategy=None, verbose=False,
+      color_type=color_type_mask_COLOR | color_type_mask_ALPHA, bit_depth=8, palette=None, transparent_color=None,
+      threads=1, stats=None, preset=None, compression_level=None, compression_strategy=None, mem_level=None, window_bits=None):
+    options = dict(default_compression_options)
+    if preset != None:
+      if preset not in compression_presets:
+        raise SimplePngError("unrecognized preset: {}. expected one of: {}".format(repr(preset), ", ".join(compression_presets)))
+      options.update(compression_presets[preset])
+      if threads > 1 and options["filter_strategy"] == "brute":
+        # the closest thing that works with threads
+        options["filter_strategy"] = "adaptive"
+    for name, value in [
+      ("filter_strategy", filter_strategy),
+      ("compression_level", compression_level),
+      ("compression_strategy", compression_strategy),
+      ("mem_level", mem_level),
+      ("window_bits", window_bits),
+      ("chunk_size", chunk_size),
+    ]:
+      if value != None:
+        options[name] = value
+    filter_strategy = options["filter_strategy"]
+    chunk_size = options["chunk_size"]
+    if not (-1 <= options["compression_level"] <= 9):
+      raise SimplePngError("compression_level must be between 0 and 9, or -1 for the default. got: {}".format(options["compression_level"]))
+    if options["compression_strategy"] not in compression_strategies:
+      raise SimplePngError("unrecognized compression strategy: {}".format(repr(options["compression_strategy"])))
+    if not (9 <= options["window_bits"] <= 15):
+      raise SimplePngError("window_bits must be between 9 and 15. got: {}".format(options["window_bits"]))
+    if not (1 <= options["mem_level"] <= 9):
+      raise SimplePngError("mem_level must be between 1 and 9. got: {}".format(options["mem_level"]))
+    if chunk_size < 1:
+      raise SimplePngError("chunk_size must be positive. got: {}".format(chunk_size))
+    # arguments for compress_block() after the data
+    self.compression_args = (options["compression_level"], options["window_bits"], options["mem_level"], options["compression_strategy"])
+    self.zlib_header = get_zlib_header(*self.compression_args[:2], options["compression_strategy"])
+    if width * height == 0:
+      raise SimplePngError("image must have > 0 pixels")
+    if bit_depth not in writable_bit_depths.get(color_type, ()):
+      raise SimplePngError("unsupported color type/bit depth combination: {}/{}".format(color_type, bit_depth))
+    if (palette != None) != bool(color_type & color_type_mask_INDEXED):
+      raise SimplePngError("palette is required for color type 3 and not allowed otherwise")
+    if palette != None and not (0 < len(palette) <= 1 << bit_depth):
+      raise SimplePngError("palette must have between 1 and {} colors. got: {}".format(1 << bit_depth, len(palette)))
+    if transparent_color != None and color_type not in (0, color_type_mask_COLOR):
+      raise SimplePngError("transparent_color not allowed for color type: {}".format(color_type))
+    if threads > 1 and filter_strategy == "brute":
+      raise SimplePngError("filter_strategy \"brute\" needs a single compressor and can't be used with threads")
+    if filter_strategy not in (0, 1, 2, 3, 4, "adaptive", "brute"):
+      raise SimplePngError("unrecognized filter strategy: {}".format(repr(filter_strategy)))
+    self.f = f
+    self.width = width
+    self.height = height
+    self.chunk_size = chunk_size
+    self.filter_strategy = filter_strategy
+    self.verbose = verbose
+    # without a PngStats, the times are recorded anyway and thrown away
+    self.stats = stats if stats != None else PngStats()
+    self.y = 0
+    self.compressed = bytearray()
+    if threads > 1:
+      self.compressor = None
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+      self.max_blocks_in_flight = 2 * threads
+      self.blocks_in_flight = collections.deque()
+      self.block = bytearray()
+      self.block_dictionary = b""
+      self.adler32 = zlib.adler32(b"")
+      self.compressed += self.zlib_header
+    else:
+      level, window_bits, mem_level, strategy = self.compression_args
+      self.compressor = zlib.compressobj(level, zlib.DEFLATED, window_bits, mem_level, strategy)
+    self.color_type = color_type
+    self.bit_depth = bit_depth
+    self.transparent_color = transparent_color
+    self.filter_left_delta = max(1, channel_counts[color_type] * bit_depth // 8)
+    self.previous = None
+    self.filter_type_histogram = collections.Counter()
+    # maps 8-bit gray values to sub-byte samples
+    self.gray_scale = 0xff // ((1 << bit_depth) - 1)
+    self.gray_to_sample_table = bytes(value // self.gray_scale for value in range(0x100))
+
+    start = time.perf_counter()
+    f.write(magic_number)
+    self.stats.bytes_out += len(magic_number)
+    self.stats.add_time("write", start)
+
+    # IHDR
+    compression = 0
+    filter_method = 0
+    interlaced = 0
+    if verbose: print(
+        "metadata: {}x{}, color_type: {}, {}-bit, compression: {}, filter_method: {}, interlaced: {}".format(
+            width, height, color_type, bit_depth, compression, filter_method, interlaced))
+    IHDR = struct.pack(IHDR_fmt, width, height, bit_depth, color_type, compression, filter_method, interlaced)
+    self.write_chunk(b"IHDR", IHDR)
+
+    if palette != None:
+      self.palette_indexes = {value: index for index, value in enumerate(palette)}
+      self.write_chunk(b"PLTE", b"".join(I4(value)[:3] for value in palette))
+      alphas = bytes(value & 0xff for value in palette).rstrip(b"\xff")
+      if len(alphas) > 0:
+        self.write_chunk(b"tRNS", alphas)
+    if transparent_color != None:
+      if color_type & color_type_mask_COLOR:
+        red, green, blue = I4(transparent_color)[:3]
+        self.write_chunk(b"tRNS", struct.pack("!HHH", red, green, blue))
+      else:
+        self.write_chunk(b"tRNS", struct.pack("!H", (transparent_color >> 24) // self.gray_scale))
+
+  def write_row(self, row):
+    # row is a sequence of 0xRRGGBBAA values, such as an array, a list, or ImageBuffer.row(y)
+    if self.y >= self.height:
+      raise SimplePngError("too many rows. height is {}".format(self.height))
+    if len(row) != self.width:
+      raise SimplePngError("expected row of width {}. got: {}".format(self.width, len(row)))
+    self.y += 1
+    stats = self.stats
+    stats.bytes_in += 4 * len(row)
+    start = time.perf_counter()
+    scanline = self.pixels_to_scanline(row)
+    start = stats.add_time("convert", start)
+    filtered = self.filter_scanline(scanline)
+    start = stats.add_time("filter", start)
+    if self.compressor != None:
+      self.compressed += self.compressor.compress(filtered)
+    else:
+      self.block += filtered
+      if len(self.block) >= parallel_block_size:
+        self.submit_block(False)
+    stats.add_time("deflate", start)
+    self.previous = scanline
+    self.write_idat_chunks(self.chunk_size)
+
+  def submit_block(self, last):
+    block = bytes(self.block)
+    self.block = bytearray()
+    self.blocks_in_flight.append(self.executor.submit(compress_block, block, self.block_dictionary, last, *self.compression_args))
+    # the end of this block, as much as fits in the window, primes the compressor for the next one
+    self.block_dictionary = block[-(1 << self.compression_args[1]):]
+    # keep the output in order, and don't let too many blocks pile up
+    while len(self.blocks_in_flight) > 0 and (last or self.blocks_in_flight[0].done() or len(self.blocks_in_flight) > self.max_blocks_in_flight):
+      compressed, block_adler32, block_length = self.blocks_in_flight.popleft().result()
+      self.compressed += compressed
+      self.adler32 = adler32_combine(self.adler32, block_adler32, block_length)
+
+  def pixels_to_scanline(self, row):
+    color_type = self.color_type
+    if color_type & color_type_mask_INDEXED:
+      try:
+        samples = bytes(map(self.palette_indexes.__getitem__, row))
+      except KeyError as e:
+        raise SimplePngError("color not in palette: 0x{:08x}".format(e.args[0]))
+      return pack_samples(samples, self.bit_depth)
+    rgba = pixels_to_bytes(row, self.transparent_color)
+    if color_type == color_type_mask_COLOR | color_type_mask_ALPHA:
+      return rgba
+    if color_type == color_type_mask_COLOR:
+      scanline = bytearray(len(rgba) // 4 * 3)
+      scanline[0::3] = rgba[0::4]
+      scanline[1::3] = rgba[1::4]
+      scanline[2::3] = rgba[2::4]
+      return scanline
+    if color_type == color_type_mask_ALPHA:
+      scanline = bytearray(len(rgba) // 2)
+      scanline[0::2] = rgba[0::4]
+      scanline[1::2] = rgba[3::4]
+      return scanline
+    # grayscale
+    samples = rgba[0::4]
+    if self.bit_depth < 8:
+      samples = samples.translate(self.gray_to_sample_table)
+    return pack_samples(samples, self.bit_depth)
+
+  def filter_scanline(self, scanline):
+    # returns the filtered scanline starting with its filter type byte
+    filter_strategy = self.filter_strategy
+    if filter_strategy == "adaptive":
+      candidates = [filter_scanline(filter_type, scanline, self.previous, self.filter_left_delta) for filter_type in range(5)]
+      filter_type = min(range(5), key=lambda filter_type: sum(candidates[filter_type].translate(signed_magnitude_table)))
+      filtered = candidates[filter_type]
+    elif filter_strategy == "brute":
+      best_size = None
+      for candidate_type in range(5):
+        candidate = bytes([candidate_type]) + filter_scanline(candidate_type, scanline, self.previous, self.filter_left_delta)
+        compressor = self.compressor.copy()
+        size = len(compressor.compress(candidate)) + len(compressor.flush(zlib.Z_SYNC_FLUSH))
+        if best_size == None or size < best_size:
+          best_size = size
+          filter_type = candidate_type
+          filtered = candidate[1:]
+    else:
+      filter_type = filter_strategy
+      filtered = filter_scanline(filter_type, scanline, self.previous, self.filter_left_delta)
+    self.filter_type_histogram[filter_type] += 1
+    return bytes([filter_type]) + filtered
+
+  def write_rows(self, rows):
+    for row in rows:
+      self.write_row(row)
+
+  def close(self):
+    if self.y != self.height:
+      raise SimplePngError("expected {} rows. got: {}".format(self.height, self.y))
+    start = time.perf_counter()
+    if self.compressor != None:
+      self.compressed += self.compressor.flush()
+    else:
+      self.submit_block(True)
+      self.executor.shutdown()
+      self.compressed += I4(self.adler32)
+    self.stats.add_time("deflate", start)
+    self.write_idat_chunks(1)
+    self.write_chunk(b"IEND", b"")
+    if self.verbose: print("filter types used: " + "   ".join("{}:{}".format(*x) for x in sorted(self.filter_type_histogram.items())))
+    self.stats.filter_type_histogram.update(self.filter_type_histogram)
+    self.stats.finish()
+
+  def write_idat_chunks(self, minimum_size):
+    compressed = self.compressed
+    chunk_size = self.chunk_size
+    cursor = 0
+    while len(compressed) - cursor >= minimum_size:
+      self.write_chunk(b"IDAT", bytes(compressed[cursor : cursor + chunk_size]))
+      cursor += chunk_size
+    del compressed[:cursor]
+
+  def write_chunk(self, type_code, body):
+    start = time.perf_counter()
+    Chunk(type_code, body).write_to(self.f)
+    self.stats.add_time("write", start)
+    self.stats.count_chunk(type_code, len(body))
+    self.stats.bytes_out += 12 + len(body)
+
+  def __enter__(self):
+    return self
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type == None:
+      self.close()
+
+def get_zlib_header(level, window_bits, strategy):
+  # the 2 byte header that zlib.compressobj() would write for these options
+  cmf = ((window_bits - 8) << 4) | zlib.DEFLATED
+  if level == zlib.Z_DEFAULT_COMPRESSION:
+    level = 6
+  if strategy >= zlib.Z_HUFFMAN_ONLY or level < 2:
+    level_flag = 0
+  else:
+    level_flag = 1 if level < 6 else 2 if level == 6 else 3
+  flg = level_flag << 6
+  flg |= 31 - (cmf * 256 + flg) % 31
+  return bytes([cmf, flg])
+# an empty deflate block marked final, to end a stream made of sync flushed pieces
+final_deflate_block = b"\x03\x00"
+
+class IncrementalPngEncoder:
+  # writes an ImageBuffer as a png over and over as it's edited,
+  # redoing only the work for the rows that changed since the last write().
+  # the filtered scanlines are kept, and the image data is compressed in segments of about segment_size bytes.
+  # each segment is compressed on its own, ending at a full flush boundary,
+  # so a segment can be compressed again without touching the others.
+  # rows are found with ImageBuffer.dirty, so changes made directly to image.data need image.mark_dirty().
+  # the other arguments are the same as for PngWriter.
+  def __init__(self, image, segment_size=parallel_block_size, **options):
+    self.image = image
+    self.width = image.width
+    self.height = image.height
+    # the writer is only used for the header chunks, the options, and to convert and filter scanlines
+    header = io.BytesIO()
+    self.row_writer = PngWriter(header, image.width, image.height, **options)
+    self.chunk_size = self.row_writer.chunk_size
+    self.header = header.getvalue()
+    self.filtered_rows = None
+    self.rows_per_segment = max(1, segment_size // (len(self.row_writer.pixels_to_scanline(image.row(0))) + 1))
+    # (compressed, adler32, length) for each segment
+    self.segments = [None] * ((self.height + self.rows_per_segment - 1) // self.rows_per_segment)
+
+  def write(self, f):
+    image = self.image
+    if (image.width, image.height) != (self.width, self.height):
+      raise SimplePngError("image size changed from {}x{} to {}x{}".format(self.width, self.height, image.width, image.height))
+    filtered_rows = self.filtered_rows
+    if filtered_rows == None:
+      filtered_rows = [None] * self.height
+      rows = range(self.height)
+    else:
+      # each row's filter can depend on the row above it
+      dirty = image.dirty
+      rows = [y for y in range(self.height) if dirty[y] or (y > 0 and dirty[y - 1])]
+
+    row_writer = self.row_writer
+    rows_per_segment = self.rows_per_segment
+    dirty_segments = set()
+    previous_y = None
+    for y in rows:
+      if y == 0:
+        row_writer.previous = None
+      elif previous_y != y - 1:
+        row_writer.previous = row_writer.pixels_to_scanline(image.row(y - 1))
+      scanline = row_writer.pixels_to_scanline(image.row(y))
+      filtered_rows[y] = row_writer.filter_scanline(scanline)
+      row_writer.previous = scanline
+      previous_y = y
+      dirty_segments.add(y // rows_per_segment)
+    for segment_index in dirty_segments:
+      start = segment_index * rows_per_segment
+      block = b"".join(filtered_rows[start : start + rows_per_segment])
+      self.segments[segment_index] = compress_block(block, b"", False, *row_writer.compression_args)
+    # only now that every changed row is in its segment. if anything above failed, the next write() does it all again.
+    self.filtered_rows = filtered_rows
+    image.clear_dirty()
+
+    compressed = bytearray(row_writer.zlib_header)
+    adler32 = zlib.adler32(b"")
+    for segment_compressed, segment_adler32, segment_length in self.segments:
+      compressed += segment_compressed
+      adler32 = adler32_combine(adler32, segment_adler32, segment_length)
+    compressed += final_deflate_block
+    compressed += I4(adler32)
+
+    f.write(self.header)
+    chunk_size = self.chunk_size
+    for start in range(0, len(compressed), chunk_size):
+      Chunk(b"IDAT", bytes(compressed[start : start + chunk_size])).write_to(f)
+    Chunk(b"IEND", b"").write_to(f)
+
+class PngStats:
+  # records where the time goes when reading or writing pngs.
+  # pass one as stats= to read_png(), iter_png_rows(), write_png() or PngWriter.
+  # everything adds up over every image it's used for,
+  # and callback, if given, is called with this object each time an image is finished.
+  # seconds maps each phase to the wall time spent in it:
+  #   reading: "read" (reading chunks), "inflate", "unfilter", "convert" (scanlines to pixels).
+  #   writing: "choose_format", "convert" (pixels to scanlines), "filter", "deflate", "write".
+  # with threads > 1, "deflate" is the time spent waiting for the compression threads.
+  # bytes_in and bytes_out count file bytes and 4 bytes per pixel, in whichever direction they went.
+  # chunk_counts and chunk_bytes are keyed by chunk type, such as "IDAT".
+  def __init__(self, callback=None):
+    self.callback = callback
+    self.seconds = collections.Counter()
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.chunk_counts = collections.Counter()
+    self.chunk_bytes = collections.Counter()
+    self.filter_type_histogram = collections.Counter()
+    self.images = 0
+  def add_time(self, phase, start):
+    # returns the current time, to start timing the next phase
+    now = time.perf_counter()
+    self.seconds[phase] += now - start
+    return now
+  def count_chunk(self, type_code, length):
+    type_code = type_code.decode("latin-1")
+    self.chunk_counts[type_code] += 1
+    self.chunk_bytes[type_code] += length
+  def finish(self):
+    self.images += 1
+    if self.callback != None:
+      self.callback(self)
+  def to_dict(self):
+    # plain values, for exporting
+    return {
+      "images": self.images,
+      "seconds": dict(self.seconds),
+      "bytes_in": self.bytes_in,
+      "bytes_out": self.bytes_out,
+      "chunk_counts": dict(self.chunk_counts),
+      "chunk_bytes": dict(self.chunk_bytes),
+      "filter_type_histogram": dict(self.filter_type_histogram),
+    }
+
+def compress_block(block, dictionary, last, level=zlib.Z_DEFAULT_COMPRESSION, window_bits=zlib.MAX_WBITS,
+    mem_level=8, strategy=zlib.Z_DEFAULT_STRATEGY):
+  # compresses one block of a zlib stream as raw deflate data that can be concatenated with the others.
+  # returns (compressed, adler32, length)
+  if len(dictionary) > 0:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level, strategy, zdict=dictionary)
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level, strategy)
+  compressed = compressor.compress(block)
+  # a sync flush ends on a byte boundary without marking the final deflate block
+  compressed += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+  return compressed, zlib.adler32(block), len(block)
+
+def adler32_combine(adler1, adler2, length2):
+  # the adler32 of two pieces of data concatenated together, adapted from zlib
+  base = 65521
+  remainder = length2 % base
+  sum1 = adler1 & 0xffff
+  sum2 = (remainder * sum1) % base
+  sum1 += (adler2 & 0xffff) + base - 1
+  sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - remainder
+  return (sum1 % base) | ((sum2 % base) << 16)
+
+def pixels_to_array(pixels):
+  # returns a new array of a sequence of 0xRRGGBBAA values
+  if isinstance(pixels, (array, memoryview)) and pixels.itemsize == 4:
+    values = array(pixel_typecode)
+    values.frombytes(memoryview(pixels).cast("B"))
+    return values
+  return array(pixel_typecode, pixels)
+
+def pixels_to_bytes(pixels, transparent_color=None):
+  # returns the RGBA bytes for a sequence of 0xRRGGBBAA values.
+  # if transparent_color is given, it replaces every 0 value.
+  values = pixels_to_array(pixels)
+  if transparent_color != None:
+    try:
+      i = values.index(0)
+      while True:
+        values[i] = transparent_color
+        i = values.index(0, i + 1)
+    except ValueError:
+      pass
+  if sys.byteorder == "little":
+    values.byteswap()
+  return values.tobytes()
+
+def pack_samples(samples, bit_depth):
+  # packs bytes of one sample each into bit_depth bits per sample with the most significant bits first
+  if bit_depth == 8:
+    return samples
+  samples_per_byte = 8 // bit_depth
+  length = (len(samples) + samples_per_byte - 1) // samples_per_byte
+  samples = bytes(samples) + bytes(length * samples_per_byte - len(samples))
+  packed = 0
+  for i in range(samples_per_byte):
+    packed |= int.from_bytes(samples[i::samples_per_byte], "big") << (8 - bit_depth * (i + 1))
+  return packed.to_bytes(length, "big")
+
+def filter_scanline(filter_type, scanline, previous, filter_left_delta):
+  # the inverse of unfilter_scanline(). returns the filtered bytes, not including the filter type byte.
+  # previous is the unfiltered scanline above, or None for the first scanline.
+  if filter_type == 0: # none
+    return bytes(scanline)
+  if numpy != None:
+    x = numpy.frombuffer(scanline, numpy.uint8).astype(numpy.int16)
+    a = numpy.zeros_like(x)
+    a[filter_left_delta:] = x[:-filter_left_delta]
+    if previous == None:
+      b = numpy.zeros_like(x)
+    else:
+      b = numpy.frombuffer(previous, numpy.uint8).astype(numpy.int16)
+    if filter_type == 1: # sub
+      predictor = a
+    elif filter_type == 2: # up
+      predictor = b
+    elif filter_type == 3: # average
+      predictor = (a + b) >> 1
+    elif filter_type == 4: # paeth
+      c = numpy.zeros_like(x)
+      c[filter_left_delta:] = b[:-filter_left_delta]
+      pa = numpy.abs(b - c)
+      pb = numpy.abs(a - c)
+      pc = numpy.abs(a + b - c - c)
+      predictor = numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+    return (x - predictor).astype(numpy.uint8).tobytes()
+
+  length = len(scanline)
+  high_bits, low_bits, _ = get_byte_masks(length)
+  # with the most significant byte first, shifting right lines up each byte with the one to its left
+  x = int.from_bytes(scanline, "big")
+  a = x >> (8 * filter_left_delta)
+  if filter_type == 1: # sub
+    return subtract_bytes_int(x, a, high_bits, low_bits).to_bytes(length, "big")
+  if previous == None:
+    if filter_type == 2: # up
+      return bytes(scanline)
+    if filter_type == 3: # average
+      return subtract_bytes_int(x, (a >> 1) & low_bits, high_bits, low_bits).to_bytes(length, "big")
+    if filter_type == 4: # paeth
+      # the predictor is always the left byte, which is the same as sub
+      return subtract_bytes_int(x, a, high_bits, low_bits).to_bytes(length, "big")
+  b = int.from_bytes(previous, "big")
+  if filter_type == 2: # up
+    return subtract_bytes_int(x, b, high_bits, low_bits).to_bytes(length, "big")
+  if filter_type == 3: # average
+    # floor((a + b) / 2) for each byte without overflowing
+    average = (a & b) + (((a ^ b) >> 1) & low_bits)
+    return subtract_bytes_int(x, average, high_bits, low_bits).to_bytes(length, "big")
+  if filter_type == 4: # paeth
+    filtered = bytearray(scanline)
+    for i in range(filter_left_delta):
+      filtered[i] = (scanline[i] - previous[i]) & 0xff
+    i = filter_left_delta
+    for a, b, c in zip(scanline, previous[filter_left_delta:], previous):
+      pa = abs(b - c)
+      pb = abs(a - c)
+      pc = abs(a + b - c - c)
+      if pa <= pb and pa <= pc:
+        filtered[i] = (filtered[i] - a) & 0xff
+      elif pb <= pc:
+        filtered[i] = (filtered[i] - b) & 0xff
+      else:
+        filtered[i] = (filtered[i] - c) & 0xff
+      i += 1
+    return bytes(filtered)
+  raise SimplePngError("unrecognized filter type: {}".format(filter_type))
+
+# maps each byte to its distance from 0 as a signed value
+signed_magnitude_table = bytes(min(i, 0x100 - i) for i in range(0x100))
 
 class Chunk:
   def __init__(self, type_code, body):
@@ -63,86 +715,486 @@ class Chunk:
     block = self.type_code + self.body
     f.write(I4(len(self.body)) + block + I4(zlib.crc32(block)))
 def read_chunk(f):
-  try:
-    [length] = struct.unpack("!I", f.read(4))
-    type_code = f.read(4)
-    body = f.read(length)
-    if len(body) < length:
+  length, type_code = read_chunk_header(f)
+  return Chunk(type_code, read_chunk_body(f, length))
+def read_chunk_header(f):
+  # returns (length, type_code)
+  header = f.read(8)
+  if len(header) < 8:
+    raise SimplePngError("unexpected EOF")
+  return struct.unpack("!I4s", header)
+def read_chunk_body(f, length):
+  # the body is a memoryview into what was read, to avoid copying it
+  body_and_crc32 = f.read(length + 4)
+  if len(body_and_crc32) < length + 4:
+    raise SimplePngError("unexpected EOF")
+  return memoryview(body_and_crc32)[:length]
+def iter_chunk_body(f, length, piece_size, stats):
+  # reads a chunk body piece_size bytes at a time, so it never has to be in memory all at once.
+  # the crc32 is skipped.
+  remaining = length
+  while remaining > 0:
+    start = time.perf_counter()
+    piece = f.read(min(piece_size, remaining))
+    stats.add_time("read", start)
+    if len(piece) == 0:
       raise SimplePngError("unexpected EOF")
-    crc32 = struct.unpack("!I", f.read(4))
-  except struct.error:
+    remaining -= len(piece)
+    yield piece
+  if len(f.read(4)) < 4:
     raise SimplePngError("unexpected EOF")
-  return Chunk(type_code, body)
+
+class BufferReader:
+  # a binary file-like object over a bytes-like object. reads return memoryview slices without copying.
+  def __init__(self, buffer):
+    self.view = memoryview(buffer).cast("B")
+    self.position = 0
+  def read(self, size=-1):
+    start = self.position
+    if size < 0:
+      self.position = len(self.view)
+    else:
+      self.position = min(start + size, len(self.view))
+    return self.view[start : self.position]
+  def tell(self):
+    return self.position
+  def seek(self, offset, whence=0):
+    if whence == 1:
+      offset += self.position
+    elif whence == 2:
+      offset += len(self.view)
+    self.position = max(0, offset)
+    return self.position
+  def release(self):
+    # lets go of the buffer. slices returned by read() keep working.
+    self.view.release()
+
+class StreamFeed:
+  # a binary file-like object for a decoder thread, fed pieces of data from the event loop.
+  # reads block until enough data has arrived.
+  def __init__(self, loop, max_pieces=4):
+    self.loop = loop
+    self.pieces = queue.SimpleQueue()
+    # the event loop waits for a slot before reading each piece,
+    # so that a fast reader can't get far ahead of a slow decoder.
+    self.slots = asyncio.Semaphore(max_pieces)
+    self.buffer = bytearray()
+    self.cursor = 0
+    self.eof = False
+  def feed(self, data):
+    # called from the event loop. empty data means EOF.
+    self.pieces.put(data)
+  def free_slot(self):
+    try:
+      self.loop.call_soon_threadsafe(self.slots.release)
+    except RuntimeError:
+      # the event loop is closed, so nobody is waiting
+      pass
+  def read(self, size=-1):
+    while not self.eof and (size < 0 or len(self.buffer) - self.cursor < size):
+      piece = self.pieces.get()
+      if len(piece) == 0:
+        self.eof = True
+        break
+      self.free_slot()
+      del self.buffer[:self.cursor]
+      self.cursor = 0
+      self.buffer += piece
+    start = self.cursor
+    self.cursor = len(self.buffer) if size < 0 else min(len(self.buffer), start + size)
+    return bytes(self.buffer[start : self.cursor])
+
+class StreamSink:
+  # a binary file-like object for an encoder thread, handing what's written to the event loop.
+  # writes block while too many pieces are waiting to be sent.
+  def __init__(self, loop, max_pieces=4):
+    self.loop = loop
+    self.pieces = asyncio.Queue()
+    self.slots = threading.Semaphore(max_pieces)
+    self.closed = False
+  def write(self, data):
+    self.slots.acquire()
+    if self.closed:
+      raise SimplePngError("the stream was closed")
+    self.loop.call_soon_threadsafe(self.pieces.put_nowait, bytes(data))
+
+@contextlib.contextmanager
+def open_source(source):
+  # source can be a binary file object, a path, or a bytes-like object holding a whole file.
+  # paths are memory mapped when possible.
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    yield BufferReader(source)
+  elif isinstance(source, (str, os.PathLike)):
+    with open(source, "rb") as f:
+      try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except (ValueError, OSError):
+        # empty files and some special files can't be mapped
+        yield f
+        return
+      reader = BufferReader(mapped)
+      try:
+        yield reader
+      finally:
+        reader.release()
+        try:
+          mapped.close()
+        except BufferError:
+          # something still has a slice of it. it will be closed when that goes away.
+          pass
+  else:
+    yield source
 
 class ImageBuffer:
   def __init__(self, width, height):
     self.width = width
     self.height = height
-    # data is formatted 0xRRGGBBAA in row-major order
-    self.data = [0] * (width * height)
+    # data is formatted 0xRRGGBBAA in row-major order,
+    # stored as a contiguous array of native-endian 32-bit integers.
+    self.data = array(pixel_typecode, [0]) * (width * height)
+    # 1 for each row changed through the methods of this class since the last clear_dirty().
+    # after writing to data or row(y) directly, call mark_dirty().
+    self.dirty = bytearray(height)
+  def mark_dirty(self, y_start=0, y_end=None):
+    if y_end == None: y_end = self.height
+    y_start = max(0, y_start)
+    y_end = min(self.height, y_end)
+    if y_start < y_end:
+      self.dirty[y_start : y_end] = b"\x01" * (y_end - y_start)
+  def dirty_rows(self):
+    return [y for y, dirty in enumerate(self.dirty) if dirty]
+  def clear_dirty(self):
+    self.dirty = bytearray(self.height)
+  def __buffer__(self, flags):
+    # python 3.12+ lets memoryview(image) see the pixel data directly
+    return memoryview(self.data)
   def set(self, x, y, value):
     self.data[y * self.width + x] = value
+    self.dirty[y] = 1
   def at(self, x, y):
     return self.data[y * self.width + x]
+  def row(self, y):
+    # a writable view of one scanline of pixels without copying
+    return memoryview(self.data)[y * self.width : (y + 1) * self.width]
+  def rows(self):
+    view = memoryview(self.data)
+    for y in range(self.height):
+      yield view[y * self.width : (y + 1) * self.width]
+  def to_array(self, copy=False):
+    # returns a (height, width, 4) numpy uint8 array of RGBA values.
+    # unless copy is True, the array shares memory with this image.
+    require_numpy()
+    pixels = numpy.frombuffer(self.data, numpy.uint8).reshape(self.height, self.width, 4)
+    if sys.byteorder == "little":
+      # 0xRRGGBBAA is stored as AA BB GG RR
+      pixels = pixels[:, :, ::-1]
+    if copy:
+      pixels = pixels.copy()
+    return pixels
+  @classmethod
+  def from_array(cls, pixels):
+    require_numpy()
+    pixels = numpy.asarray(pixels)
+    if pixels.ndim != 3 or pixels.shape[2] != 4:
+      raise SimplePngError("expected an array of shape (height, width, 4). got: {}".format(pixels.shape))
+    height, width, _ = pixels.shape
+    image = cls(width, height)
+    image.to_array()[...] = pixels
+    return image
   def paste(self, other, sx=0, sy=0, dx=0, dy=0, width=None, height=None, flip_h=False, rotate=0):
     if width == None:
       width = min(self.width - dx, other.width - sx)
     if height == None:
       height = min(self.height - dy, other.height - sy)
-    if flip_h or rotate != 0:
-      other = other.copy(sx=sx, sy=sy, width=width, height=height)
+    if flip_h or rotate % 4 != 0:
+      if (sx, sy, width, height) != (0, 0, other.width, other.height):
+        other = other.copy(sx=sx, sy=sy, width=width, height=height)
       sx = 0
       sy = 0
-      if flip_h: other.flip_h()
-      if rotate != 0: other.rotate(rotate)
+      # these return new buffers, so other is never modified
+      if flip_h: other = other.flipped_h()
+      if rotate % 4 != 0: other = other.rotated(rotate)
+      width = min(self.width - dx, other.width)
+      height = min(self.height - dy, other.height)
+    if width > 0:
+      self.mark_dirty(dy, dy + height)
+    if numpy != None:
+      if width > 0 and height > 0:
+        numpy_paste(self, other, sx, sy, dx, dy, width, height)
+      return
+    source_data = other.data
     for y in range(height):
-      for x in range(width):
-        value = other.at(sx + x, sy + y)
-        alpha = value & 0xff
-        if alpha == 0:
-          continue
-        if alpha < 255:
-          value = alpha_blend(value, self.at(dx + x, dy + y))
-        self.set(dx + x, dy + y, value)
+      source_start = (sy + y) * other.width + sx
+      source_row = source_data[source_start : source_start + width]
+      blend_row(self.data, (dy + y) * self.width + dx, source_row, pixels_to_bytes(source_row)[3::4])
+  def clip_rect(self, rect):
+    # returns (x, y, width, height) of the part of rect inside the image. None means the whole image.
+    if rect == None:
+      return 0, 0, self.width, self.height
+    x, y, width, height = rect
+    x_end = min(self.width, x + width)
+    y_end = min(self.height, y + height)
+    x = max(0, x)
+    y = max(0, y)
+    return x, y, max(0, x_end - x), max(0, y_end - y)
+  def fill(self, rect, value):
+    # sets every pixel in rect, (x, y, width, height) or None for the whole image, to value
+    x, y, width, height = self.clip_rect(rect)
+    if width == 0 or height == 0:
+      return
+    self.mark_dirty(y, y + height)
+    if width == self.width:
+      self.data[y * width : (y + height) * width] = array(pixel_typecode, [value]) * (width * height)
+      return
+    row = array(pixel_typecode, [value]) * width
+    for row_start in range(y * self.width + x, (y + height) * self.width, self.width):
+      self.data[row_start : row_start + width] = row
+  def clear(self, rect=None):
+    self.fill(rect, 0)
+  def blit(self, other, sx=0, sy=0, dx=0, dy=0, width=None, height=None):
+    # like paste(), but copies the pixels without blending. anything outside either image is skipped.
+    # other can be this image, and the areas can overlap.
+    if width == None: width = other.width - sx
+    if height == None: height = other.height - sy
+    # clip to both images
+    if sx < 0: width, dx, sx = width + sx, dx - sx, 0
+    if dx < 0: width, sx, dx = width + dx, sx - dx, 0
+    if sy < 0: height, dy, sy = height + sy, dy - sy, 0
+    if dy < 0: height, sy, dy = height + dy, sy - dy, 0
+    width = min(width, other.width - sx, self.width - dx)
+    height = min(height, other.height - sy, self.height - dy)
+    if width <= 0 or height <= 0:
+      return
+    self.mark_dirty(dy, dy + height)
+    source_data = other.data
+    dest_data = self.data
+    if sx == 0 and dx == 0 and width == self.width == other.width:
+      # whole rows are contiguous. the slice is copied before it's assigned, so overlapping is fine.
+      dest_data[dy * width : (dy + height) * width] = source_data[sy * width : (sy + height) * width]
+      return
+    rows = range(height)
+    if other is self and dy > sy:
+      # copy from the bottom up so that rows aren't overwritten before they're copied
+      rows = reversed(rows)
+    for y in rows:
+      source_start = (sy + y) * other.width + sx
+      dest_start = (dy + y) * self.width + dx
+      dest_data[dest_start : dest_start + width] = source_data[source_start : source_start + width]
+  def scroll(self, dx, dy, value=0):
+    # moves the pixels right by dx and down by dy, filling the uncovered area with value
+    self.blit(self, dx=dx, dy=dy)
+    if dx > 0:
+      self.fill((0, 0, dx, self.height), value)
+    elif dx < 0:
+      self.fill((self.width + dx, 0, -dx, self.height), value)
+    if dy > 0:
+      self.fill((0, 0, self.width, dy), value)
+    elif dy < 0:
+      self.fill((0, self.height + dy, self.width, -dy), value)
   def copy(self, sx=0, sy=0, width=None, height=None):
     if width == None: width = self.width
     if height == None: height = self.height
+    if not (0 <= sx and 0 <= sy and sx + width <= self.width and sy + height <= self.height):
+      # slicing would silently copy fewer pixels
+      raise IndexError("copy rect is out of bounds")
     other = ImageBuffer(width, height)
+    if sx == 0 and width == self.width:
+      other.data[:] = self.data[sy * width : (sy + height) * width]
+      return other
     for y in range(height):
-      for x in range(width):
-        other.set(x, y, self.at(x + sx, y + sy))
+      source_start = (sy + y) * self.width + sx
+      other.data[y * width : (y + 1) * width] = self.data[source_start : source_start + width]
     return other
   def flip_h(self):
+    self.mark_dirty()
+    data = self.data
+    for start in range(0, self.width * self.height, self.width):
+      data[start : start + self.width] = data[start : start + self.width][::-1]
+  def flip_v(self):
+    self.data[:] = self.flipped_v().data
+    self.mark_dirty()
+  def flipped_h(self):
+    other = self.copy()
+    other.flip_h()
+    return other
+  def flipped_v(self):
+    other = ImageBuffer(self.width, self.height)
+    width = self.width
     for y in range(self.height):
-      for x in range(self.width // 2):
-        x2 = self.width - 1 - x
-        tmp = self.at(x, y)
-        self.set(x, y, self.at(x2, y))
-        self.set(x2, y, tmp)
+      source_start = (self.height - 1 - y) * width
+      other.data[y * width : (y + 1) * width] = self.data[source_start : source_start + width]
+    return other
   def rotate(self, quarter_turns):
-    for y in range(self.height // 2):
-      y2 = self.height - 1 - y
-      for x in range(self.width // 2):
-        x2 = self.width - 1 - x
-        tmp = self.at(x, y)
+    # positive quarter turns are clockwise. works for any width and height.
+    other = self.rotated(quarter_turns)
+    self.data[:] = other.data
+    self.width = other.width
+    self.height = other.height
+    self.dirty = bytearray(b"\x01") * self.height
+  def rotated(self, quarter_turns):
+    quarter_turns %= 4
+    if quarter_turns == 0:
+      return self.copy()
+    if quarter_turns == 2:
+      other = ImageBuffer(self.width, self.height)
+      other.data[:] = self.data[::-1]
+      return other
+    # a transpose done in bands of source rows, so each band stays in cache
+    # while one strided slice per column copies it into a destination row.
+    width = self.width
+    height = self.height
+    data = self.data
+    other = ImageBuffer(height, width)
+    out = other.data
+    band_height = max(1, transpose_band_size // (4 * width))
+    for band_start in range(0, height, band_height):
+      band_end = min(height, band_start + band_height)
+      for y in range(width):
         if quarter_turns == 1:
-          self.set(x, y, self.at(y, x2))
-          self.set(y, x2, self.at(x2, y2))
-          self.set(x2, y2, self.at(y2, x))
-          self.set(y2, x, tmp)
-        elif quarter_turns == -1:
-          self.set(x, y, self.at(y2, x))
-          self.set(y2, x, self.at(x2, y2))
-          self.set(x2, y2, self.at(y, x2))
-          self.set(y, x2, tmp)
-
-def subtract_bytes(a, b):
-  return (
-    (((a & 0xff000000) - (b & 0xff000000)) & 0xff000000) |
-    (((a & 0x00ff0000) - (b & 0x00ff0000)) & 0x00ff0000) |
-    (((a & 0x0000ff00) - (b & 0x0000ff00)) & 0x0000ff00) |
-    (((a & 0x000000ff) - (b & 0x000000ff)) & 0x000000ff)
-  )
+          # destination row y is source column y, from the bottom up
+          column = data[band_start * width + y : band_end * width : width]
+          out[y * height + height - band_end : y * height + height - band_start] = column[::-1]
+        else:
+          # destination row y is source column width - 1 - y, from the top down
+          column = data[band_start * width + width - 1 - y : band_end * width : width]
+          out[y * height + band_start : y * height + band_end] = column
+    return other
+# bytes of source rows transposed at a time by ImageBuffer.rotated()
+transpose_band_size = 0x40000
+
+class SharedImageBuffer(ImageBuffer):
+  # an image whose pixels are shared with other callers, like the ones PngCache.read_png(shared=True) returns.
+  # the methods that would change it raise SimplePngError, and its views are read-only,
+  # but data is still the shared array itself and must be treated as read-only.
+  # copy() returns an ordinary ImageBuffer that can be changed.
+  def __init__(self, image):
+    self.width = image.width
+    self.height = image.height
+    self.data = image.data
+    self.dirty = image.dirty
+  def refuse_change(self, *args, **kwargs):
+    raise SimplePngError("this image is shared and can't be changed. copy() it first.")
+  set = paste = fill = clear = blit = scroll = flip_h = flip_v = rotate = mark_dirty = clear_dirty = refuse_change
+  def __buffer__(self, flags):
+    return memoryview(self.data).toreadonly()
+  def row(self, y):
+    return ImageBuffer.row(self, y).toreadonly()
+  def rows(self):
+    for row in ImageBuffer.rows(self):
+      yield row.toreadonly()
+  def to_array(self, copy=False):
+    if copy:
+      return ImageBuffer.to_array(self, copy)
+    # made from a read-only view, so that writeable can't be turned back on
+    require_numpy()
+    pixels = numpy.frombuffer(memoryview(self.data).toreadonly(), numpy.uint8).reshape(self.height, self.width, 4)
+    if sys.byteorder == "little":
+      pixels = pixels[:, :, ::-1]
+    return pixels
+
+# runs of opaque pixels or translucent pixels in a row of alpha values
+alpha_run_pattern = re.compile(rb"\xff+|[\x01-\xfe]+")
+
+def flatten(layers, canvas_size=None, background=None):
+  # composites a stack of (image, (x, y), flip_h, rotate) layers, listed from bottom to top,
+  # onto a transparent canvas or onto a copy of background.
+  # the result is the same as pasting each layer in order,
+  # but each row is done in one pass from the top layer down to the first opaque pixel,
+  # so the parts of lower layers that end up covered are never blended.
+  if background != None:
+    canvas = background.copy()
+  else:
+    canvas = ImageBuffer(*canvas_size)
+  placed = []
+  for image, (x, y), flip_h, rotate in layers:
+    if flip_h: image = image.flipped_h()
+    if rotate % 4 != 0: image = image.rotated(rotate)
+    # clip to the canvas
+    sx = max(0, -x)
+    sy = max(0, -y)
+    dx = max(0, x)
+    dy = max(0, y)
+    width = min(image.width - sx, canvas.width - dx)
+    height = min(image.height - sy, canvas.height - dy)
+    if width > 0 and height > 0:
+      placed.append((image, sx, sy, dx, dy, width, height))
+  if numpy != None:
+    numpy_flatten(canvas, placed)
+    return canvas
+  # the masks are big-endian ints with a byte per pixel, so they're combined a whole row at a time
+  row_mask = (1 << (8 * canvas.width)) - 1
+  for y in range(canvas.height):
+    # 0xff where no higher layer has an opaque pixel yet
+    uncovered = row_mask
+    visible = []
+    for image, sx, sy, dx, dy, width, height in reversed(placed):
+      if not (dy <= y < dy + height):
+        continue
+      source_start = (sy + y - dy) * image.width + sx
+      source_row = image.data[source_start : source_start + width]
+      alpha = pixels_to_bytes(source_row)[3::4]
+      shift = 8 * (canvas.width - dx - width)
+      # covered pixels become transparent, so blend_row() skips them
+      visible_alpha = int.from_bytes(alpha, "big") & (uncovered >> shift)
+      if visible_alpha == 0:
+        # everything in this row is covered or transparent, so it doesn't cover anything new either
+        continue
+      visible.append((dx, source_row, visible_alpha.to_bytes(width, "big")))
+      uncovered &= ~(int.from_bytes(alpha.translate(opaque_mask_table), "big") << shift)
+      if uncovered == 0:
+        break
+    row_start = y * canvas.width
+    for dx, source_row, alpha in reversed(visible):
+      blend_row(canvas.data, row_start + dx, source_row, alpha)
+  return canvas
+# maps opaque alpha values to 0xff and the rest to 0
+opaque_mask_table = bytes(0xff if a == 0xff else 0 for a in range(0x100))
+
+def blend_row(dest_data, dest_start, source_row, alpha):
+  # pastes a row of pixels at dest_start, using the alpha bytes to find runs of pixels:
+  # opaque runs are copied, transparent runs are skipped, and translucent runs are blended.
+  multiply_tables, divide_tables, out_alpha_table = get_blend_tables()
+  for run in alpha_run_pattern.finditer(alpha):
+    start, end = run.span()
+    if alpha[start] == 0xff:
+      dest_data[dest_start + start : dest_start + end] = source_row[start : end]
+      continue
+    blended = []
+    append = blended.append
+    for foreground, background in zip(source_row[start : end], dest_data[dest_start + start : dest_start + end]):
+      back_a = background & 0xff
+      if back_a == 0:
+        append(foreground)
+        continue
+      # the same arithmetic as alpha_blend()
+      fore_a = foreground & 0xff
+      out_a = out_alpha_table[(fore_a << 8) | back_a]
+      multiply = multiply_tables[fore_a]
+      divide = divide_tables[out_a]
+      # how much of each background channel shows through: c * w // 0xff // 0xff, in one step
+      w = back_a * (0xff - fore_a)
+      append(
+        (divide[multiply[foreground >> 24] + (background >> 24) * w // 65025] << 24) |
+        (divide[multiply[(foreground >> 16) & 0xff] + ((background >> 16) & 0xff) * w // 65025] << 16) |
+        (divide[multiply[(foreground >> 8) & 0xff] + ((background >> 8) & 0xff) * w // 65025] << 8) |
+        out_a
+      )
+    dest_data[dest_start + start : dest_start + end] = array(pixel_typecode, blended)
+
+blend_tables = None
+def get_blend_tables():
+  # returns (multiply_tables, divide_tables, out_alpha_table) for blending without any math:
+  # multiply_tables[a][c] is c * a // 0xff.
+  # divide_tables[a][s] is s * 0xff // a.
+  # out_alpha_table[fore_a << 8 | back_a] is the alpha of the blend.
+  global blend_tables
+  if blend_tables == None:
+    multiply_tables = [[c * a // 0xff for c in range(0x100)] for a in range(0x100)]
+    divide_tables = [None] + [[s * 0xff // a for s in range(0x1ff)] for a in range(1, 0x100)]
+    out_alpha_table = [fore_a + back_a * (0xff - fore_a) // 0xff for fore_a in range(0x100) for back_a in range(0x100)]
+    blend_tables = (multiply_tables, divide_tables, out_alpha_table)
+  return blend_tables
+
 def alpha_blend(foreground, background):
   back_a = background & 0xff
   if back_a == 0:
@@ -165,16 +1217,136 @@ def alpha_blend(foreground, background):
     (out_a <<  0)
   )
 
+def require_numpy():
+  if numpy == None:
+    raise ImportError("numpy is required for this operation")
+def numpy_pixels(image):
+  # a (height, width) uint32 numpy array sharing memory with the image
+  return numpy.frombuffer(image.data, numpy.uint32).reshape(image.height, image.width)
+def numpy_paste(dest, source, sx, sy, dx, dy, width, height, mask=None):
+  # mask, if given, limits which pixels are pasted
+  source_pixels = numpy_pixels(source)[sy : sy + height, sx : sx + width]
+  if source is dest:
+    source_pixels = source_pixels.copy()
+  dest_pixels = numpy_pixels(dest)[dy : dy + height, dx : dx + width]
+  alpha = source_pixels & 0xff
+  opaque = alpha == 0xff
+  translucent = (alpha != 0) & ~opaque
+  if mask is not None:
+    opaque &= mask
+    translucent &= mask
+  dest_pixels[opaque] = source_pixels[opaque]
+  if translucent.any():
+    dest_pixels[translucent] = numpy_alpha_blend(source_pixels[translucent], dest_pixels[translucent])
+def numpy_flatten(canvas, placed):
+  # find the pixels of each layer not covered by an opaque pixel of a higher layer,
+  # then paste only those from the bottom up.
+  uncovered = numpy.ones((canvas.height, canvas.width), dtype=bool)
+  masks = []
+  for image, sx, sy, dx, dy, width, height in reversed(placed):
+    region = uncovered[dy : dy + height, dx : dx + width]
+    masks.append(region.copy())
+    region &= (numpy_pixels(image)[sy : sy + height, sx : sx + width] & 0xff) != 0xff
+  for layer, mask in zip(placed, reversed(masks)):
+    numpy_paste(canvas, *layer, mask=mask)
+def numpy_alpha_blend(foreground, background):
+  # the same integer arithmetic as alpha_blend() for arrays of pixels
+  foreground = foreground.astype(numpy.int64)
+  background = background.astype(numpy.int64)
+  fore_a = foreground & 0xff
+  back_a = background & 0xff
+  out_a = fore_a + back_a * (0xff - fore_a) // 0xff
+  divisor = numpy.maximum(out_a, 1)
+  out = out_a.copy()
+  for shift in (24, 16, 8):
+    fore_c = (foreground >> shift) & 0xff
+    back_c = (background >> shift) & 0xff
+    out |= ((fore_c * fore_a // 0xff + back_c * back_a * (0xff - fore_a) // 0xff // 0xff) * 0xff // divisor) << shift
+  return numpy.where(back_a == 0, foreground, out).astype(numpy.uint32)
+
 class SimplePngError(Exception):
   pass
 
-def read_png(f, verbose=False):
+def read_png(f, verbose=False, region=None, progress=None, max_pass=None, stats=None):
+  # f is a binary file object, a path, or a bytes-like object holding the whole file.
+  # region is (x, y, width, height) to decode only that part of the image.
+  # decoding stops once the last scanline the region needs is unfiltered,
+  # so the rest of the file is not read or checked.
+  # progress is called with (pass_number, preview) after each interlace pass, numbered from 1,
+  # where preview is the full size image with each decoded pixel filling the block it stands for.
+  # max_pass stops decoding after that pass, and returns an image with one pixel per block.
+  # stats is a PngStats to record where the time goes.
+  with open_source(f) as f:
+    decoder = PngDecoder(f, verbose, stats)
+    image = decoder.read_image(region, progress, max_pass)
+    decoder.finish_stats()
+    return image
+
+def iter_png_rows(f, verbose=False, stats=None):
+  # yields each row of the image from top to bottom as an array of 0xRRGGBBAA values.
+  # for non-interlaced images, rows are yielded as soon as they are decoded,
+  # and memory usage does not depend on the height of the image.
+  with open_source(f) as f:
+    decoder = PngDecoder(f, verbose, stats)
+    yield from iter_decoded_rows(decoder)
+    decoder.finish_stats()
+
+async def read_png_async(reader, executor=None, piece_size=0x10000, **options):
+  # reader is an asyncio.StreamReader, or anything with an async read(n).
+  # the image is decoded by read_png() in executor, a thread pool, or the event loop's default executor,
+  # starting as soon as the first bytes arrive. options are passed to read_png().
+  loop = asyncio.get_running_loop()
+  feed = StreamFeed(loop)
+  decoding = loop.run_in_executor(executor, lambda: read_png(feed, **options))
+  # wakes us up if the decoder finishes or fails while we're waiting for a slot
+  decoding.add_done_callback(lambda future: feed.slots.release())
+  try:
+    # stop early if decoding fails
+    while not decoding.done():
+      await feed.slots.acquire()
+      if decoding.done():
+        break
+      data = await reader.read(piece_size)
+      feed.feed(data)
+      if len(data) == 0:
+        break
+    return await decoding
+  finally:
+    # lets the decoder stop if we're interrupted
+    feed.feed(b"")
+    if not decoding.done():
+      decoding.cancel()
+    elif not decoding.cancelled():
+      # marks any error as retrieved, since we're already raising something else
+      decoding.exception()
+
+def iter_decoded_rows(decoder):
+  width = decoder.width
+  if decoder.interlaced != 0:
+    # no row is complete until the last pass
+    image = decoder.read_image()
+    for y in range(image.height):
+      yield image.data[y * width : (y + 1) * width]
+    return
+  stats = decoder.stats
+  for _, _, scanline in decoder.iter_scanlines():
+    start = time.perf_counter()
+    row = decoder.convert_rows(scanline, width, 1)
+    stats.add_time("convert", start)
+    stats.bytes_out += 4 * width
+    yield row
+  decoder.print_filter_types()
+
+decompress_piece_size = 0x10000
+
+def read_header(f):
+  # reads the signature and the IHDR chunk. returns the IHDR fields.
   try:
     first_bytes = f.read(len(magic_number))
   except UnicodeDecodeError:
     # trigger the non-bytes error below
     first_bytes = ""
-  if type(first_bytes) != bytes:
+  if not isinstance(first_bytes, (bytes, memoryview)):
     raise SimplePngError("file must be open in binary mode")
   if first_bytes != magic_number:
     raise SimplePngError("not a png image")
@@ -183,365 +1355,490 @@ def read_png(f, verbose=False):
   if IHDR.type_code != b"IHDR":
     raise SimplePngError("expected first chunk to be IHDR")
   try:
-    width, height, bit_depth, color_type, compression, filter_method, interlaced = struct.unpack(IHDR_fmt, IHDR.body)
+    return struct.unpack(IHDR_fmt, IHDR.body)
   except struct.error:
     raise SimplePngError("malformed IHDR")
-  if verbose: print(
-      "metadata: {}x{}, color_type: {}, {}-bit, compression: {}, filter_method: {}, interlaced: {}".format(
-          width, height, color_type, bit_depth, compression, filter_method, interlaced))
-  if width * height == 0:
-    raise SimplePngError("image must have > 0 pixels")
-  if compression != 0:
-    raise SimplePngError("unsupported compression method: {}".format(compression))
-  if filter_method != 0:
-    raise SimplePngError("unsupported filter method: {}".format(filter_method))
-
-  if (color_type, bit_depth) == (0, 1):
-    bits_per_pixel = 1
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0xffffff00 * (
-          (idat_data[scanline_start + bit_index // 8] >> (7 - (bit_index & 7))) & 0x1
-        )
-      ) | 0xff
-    make_read_color_for_trns = make_simple_grayscale_make_read_color_for_trns(0xffffff00, read_color)
-  elif (color_type, bit_depth) == (0, 2):
-    bits_per_pixel = 2
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x55555500 * (
-          (idat_data[scanline_start + bit_index // 8] >> (6 - (bit_index & 6))) & 0x3
-        )
-      ) | 0xff
-    make_read_color_for_trns = make_simple_grayscale_make_read_color_for_trns(0x55555500, read_color)
-  elif (color_type, bit_depth) == (0, 4):
-    bits_per_pixel = 4
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x11111100 * (
-          (idat_data[scanline_start + bit_index // 8] >> (4 - (bit_index & 4))) & 0xf
-        )
-      ) | 0xff
-    make_read_color_for_trns = make_simple_grayscale_make_read_color_for_trns(0x11111100, read_color)
-  elif (color_type, bit_depth) == (0, 8):
-    bits_per_pixel = 8
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x01010100 * idat_data[scanline_start + bit_index // 8]
-      ) | 0xff
-    make_read_color_for_trns = make_simple_grayscale_make_read_color_for_trns(0x01010100, read_color)
-  elif (color_type, bit_depth) == (0, 16):
-    bits_per_pixel = 16
-    filter_left_delta = 2
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x01010100 * idat_data[scanline_start + bit_index // 8]
-      ) | 0xff
-    original_read_color = read_color
-    def make_read_color_for_trns(trns_body):
-      magic_list_slice = list(trns_body)
-      def new_read_color(idat_data, scanline_start, bit_index):
-        if idat_data[scanline_start + bit_index // 8 : scanline_start + bit_index // 8 + 2] == magic_list_slice:
-          return 0
-        return original_read_color(idat_data, scanline_start, bit_index)
-      return new_read_color
-  elif (color_type, bit_depth) == (2, 8):
-    bits_per_pixel = 24
-    filter_left_delta = 3
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        idat_data[scanline_start + bit_index // 8] << 24
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 1] << 16
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 2] << 8
-      ) | 0xff
-    original_read_color = read_color
-    def make_read_color_for_trns(trns_body):
-      magic_value = (
-        trns_body[1] << 24
-      ) | (
-        trns_body[3] << 16
-      ) | (
-        trns_body[5] << 8
-      ) | 0xff
-      def new_read_color(*args):
-        nominal_value = original_read_color(*args)
-        if nominal_value == magic_value: return 0
-        return nominal_value
-      return new_read_color
-  elif (color_type, bit_depth) == (2, 16):
-    bits_per_pixel = 48
-    filter_left_delta = 6
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        idat_data[scanline_start + bit_index // 8] << 24
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 2] << 16
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 4] << 8
-      ) | 0xff
-    original_read_color = read_color
-    def make_read_color_for_trns(trns_body):
-      magic_list_slice = list(trns_body)
-      def new_read_color(idat_data, scanline_start, bit_index):
-        if idat_data[scanline_start + bit_index // 8 : scanline_start + bit_index // 8 + 6] == magic_list_slice:
-          return 0
-        return original_read_color(idat_data, scanline_start, bit_index)
-      return new_read_color
-  elif (color_type, bit_depth) == (3, 1):
-    bits_per_pixel = 1
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (idat_data[scanline_start + bit_index // 8] >> (7 - (bit_index & 7))) & 0x1
-  elif (color_type, bit_depth) == (3, 2):
-    bits_per_pixel = 2
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (idat_data[scanline_start + bit_index // 8] >> (6 - (bit_index & 6))) & 0x3
-  elif (color_type, bit_depth) == (3, 4):
-    bits_per_pixel = 4
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return (idat_data[scanline_start + bit_index // 8] >> (4 - (bit_index & 4))) & 0xf
-  elif (color_type, bit_depth) == (3, 8):
-    bits_per_pixel = 8
-    filter_left_delta = 1
-    def read_color(idat_data, scanline_start, bit_index):
-      return idat_data[scanline_start + bit_index // 8]
-  elif (color_type, bit_depth) == (4, 8):
-    bits_per_pixel = 16
-    filter_left_delta = 2
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x01010100 * idat_data[scanline_start + bit_index // 8]
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 1]
-      )
-  elif (color_type, bit_depth) == (4, 16):
-    bits_per_pixel = 32
-    filter_left_delta = 4
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        0x01010100 * idat_data[scanline_start + bit_index // 8]
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 2]
-      )
-  elif (color_type, bit_depth) == (6, 8):
-    bits_per_pixel = 32
-    filter_left_delta = 4
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        idat_data[scanline_start + bit_index // 8] << 24
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 1] << 16
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 2] << 8
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 3]
-      )
-  elif (color_type, bit_depth) == (6, 16):
-    bits_per_pixel = 64
-    filter_left_delta = 8
-    def read_color(idat_data, scanline_start, bit_index):
-      return (
-        idat_data[scanline_start + bit_index // 8] << 24
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 2] << 16
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 4] << 8
-      ) | (
-        idat_data[scanline_start + bit_index // 8 + 6]
-      )
-  else:
-    raise SimplePngError("unsupported color type/bit depth combination: {}/{}".format(color_type, bit_depth))
 
-  if interlaced == 0:
-    interlacing = no_interlacing
-  elif interlaced == 1:
-    interlacing = adam7_interlacing
-  else:
-    raise SimplePngError("unsupported interlace method: {}".format(interlaced))
-
-  pixel_sizes = [(
-    (width  + x_scale - x_offset - 1) // x_scale,
-    (height + y_scale - y_offset - 1) // y_scale,
-  ) for (x_scale, x_offset, y_scale, y_offset) in interlacing]
-  # make sure all pixels are accounted for
-  assert width * height == sum(w * h for (w, h) in pixel_sizes)
-
-  scanline_lengths = [
-    # filter types are present only for >0 width subimages
-    int(bool(w)) + (w * bits_per_pixel + 7) // 8
-    for (w, _) in pixel_sizes
-  ]
-  expected_idat_data_len = sum(scanline_length * h for (scanline_length, (_, h)) in zip(scanline_lengths, pixel_sizes))
-
-  # read all the chunks we care about
-  idat_accumulator = []
-  decompressor = zlib.decompressobj()
-  palette = None
+class PngCache:
+  # keeps decoded images in memory, evicting the least recently used ones
+  # when their pixel data adds up to more than max_bytes.
+  # paths are keyed by their size and modification time, or by a hash of their contents if hash_contents is True.
+  # bytes-like objects and file objects are always keyed by a hash of their contents.
+  def __init__(self, max_bytes=0x10000000, hash_contents=False):
+    self.max_bytes = max_bytes
+    self.hash_contents = hash_contents
+    self.entries = collections.OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+  def read_png(self, source, verbose=False, shared=False):
+    # returns a copy of the cached image, so callers can't change what other callers get.
+    # with shared=True, returns the cached image itself, as a SharedImageBuffer.
+    # its methods won't change it, but its data must not be written to either.
+    if isinstance(source, (str, os.PathLike)) and not self.hash_contents:
+      stat = os.stat(source)
+      key = (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+    else:
+      if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+          source = f.read()
+      elif not isinstance(source, (bytes, bytearray, memoryview)):
+        source = source.read()
+      key = hashlib.sha256(source).digest()
+    with self.lock:
+      image = self.entries.get(key)
+      if image != None:
+        self.entries.move_to_end(key)
+        self.hits += 1
+      else:
+        self.misses += 1
+    if image == None:
+      # decode without holding the lock. two threads might both decode the same image.
+      image = SharedImageBuffer(read_png(source, verbose=verbose))
+      self.put(key, image)
+    if shared:
+      return image
+    return image.copy()
+  def put(self, key, image):
+    if not isinstance(image, SharedImageBuffer):
+      image = SharedImageBuffer(image)
+    image_size = len(image.data) * image.data.itemsize
+    if image_size > self.max_bytes:
+      return
+    with self.lock:
+      if key in self.entries:
+        return
+      self.entries[key] = image
+      self.size += image_size
+      while self.size > self.max_bytes:
+        _, evicted = self.entries.popitem(last=False)
+        self.size -= len(evicted.data) * evicted.data.itemsize
+        self.evictions += 1
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+  def __len__(self):
+    return len(self.entries)
+
+ChunkLocation = collections.namedtuple("ChunkLocation", ["type_code", "offset", "length"])
+
+class PngInfo:
+  def __init__(self, width, height, bit_depth, color_type, compression, filter_method, interlaced, palette_size, chunks):
+    self.width = width
+    self.height = height
+    self.bit_depth = bit_depth
+    self.color_type = color_type
+    self.compression = compression
+    self.filter_method = filter_method
+    self.interlaced = interlaced
+    # the number of PLTE entries, or None
+    self.palette_size = palette_size
+    # a ChunkLocation for every chunk after IHDR, up to and including IEND.
+    # offset is the position in the file of the start of the chunk; the body starts 8 bytes later.
+    self.chunks = chunks
+
+def read_png_info(f):
+  # reads the header and the locations of the chunks without reading or decompressing any chunk bodies.
+  with open_source(f) as f:
+    return read_info(f)
+
+def read_info(f):
+  width, height, bit_depth, color_type, compression, filter_method, interlaced = read_header(f)
+  palette_size = None
+  chunks = []
   while True:
-    chunk = read_chunk(f)
-    if chunk.type_code == b"IEND":
-      if len(f.read(1)) != 0:
-        raise SimplePngError("expected EOF")
+    offset = f.tell()
+    header = f.read(8)
+    if len(header) < 8:
+      raise SimplePngError("unexpected EOF")
+    length, type_code = struct.unpack("!I4s", header)
+    chunks.append(ChunkLocation(type_code, offset, length))
+    if type_code == b"PLTE" and palette_size == None:
+      palette_size = length // 3
+    if type_code == b"IEND":
       break
-    elif chunk.type_code == b"PLTE":
-      if color_type & color_type_mask_INDEXED:
-        if palette != None:
-          raise SimplePngError("multiple PLTE chunks")
-        if len(chunk.body) == 0:
-          raise SimplePngError("empty PLTE chunk")
-        if len(chunk.body) % 3 != 0:
-          raise SimplePngError("PLTE chunk length must be a multiple of 3")
-        palette = [struct.unpack("!I", bytes(rgb + (0xff,)))[0] for rgb in zip(*[iter(chunk.body)]*3)]
-      else:
-        if verbose: print("WARNING: ignoring PLTE chunk. color_type {} does not require a palette".format(color_type))
-    elif chunk.type_code == b"tRNS":
-      if color_type & color_type_mask_ALPHA:
-        raise SimplePngError("tRNS chunk not allowed for color type: {}".format(color_type))
-      if color_type & color_type_mask_INDEXED:
-        if palette == None:
-          raise SimplePngError("tRNS must come after PLTE")
-        if len(chunk.body) > len(palette):
-          raise SimplePngError("too many tRNS values. {} > {}".format(len(chunk.body), len(palette)))
-        for i in range(len(chunk.body)):
-          palette[i] = (palette[i] & 0xffffff00) | chunk.body[i]
-      else:
-        if color_type & color_type_mask_COLOR:
-          expected_trns_length = 6
-        else:
-          expected_trns_length = 2
-        if len(chunk.body) != expected_trns_length:
-          raise SimplePngError("expected tRNS length {}. got: {}".format(expected_trns_length, len(chunk.body)))
-        read_color = make_read_color_for_trns(chunk.body)
-    elif chunk.type_code == b"IDAT":
-      if (color_type & color_type_mask_INDEXED) and palette == None:
-        raise SimplePngError("missing PLTE chunk")
-      idat_accumulator.append(decompressor.decompress(chunk.body))
+    # skip the body and the crc
+    f.seek(length + 4, 1)
+  return PngInfo(width, height, bit_depth, color_type, compression, filter_method, interlaced, palette_size, chunks)
+
+class PngDecoder:
+  def __init__(self, f, verbose=False, stats=None):
+    self.f = f
+    self.verbose = verbose
+    # without a PngStats, the times are recorded anyway and thrown away
+    self.stats = stats if stats != None else PngStats()
+    start = time.perf_counter()
+    width, height, bit_depth, color_type, compression, filter_method, interlaced = read_header(f)
+    self.stats.add_time("read", start)
+    self.stats.bytes_in += len(magic_number) + 12 + struct.calcsize(IHDR_fmt)
+    self.stats.count_chunk(b"IHDR", struct.calcsize(IHDR_fmt))
+    if verbose: print(
+        "metadata: {}x{}, color_type: {}, {}-bit, compression: {}, filter_method: {}, interlaced: {}".format(
+            width, height, color_type, bit_depth, compression, filter_method, interlaced))
+    if width * height == 0:
+      raise SimplePngError("image must have > 0 pixels")
+    if compression != 0:
+      raise SimplePngError("unsupported compression method: {}".format(compression))
+    if filter_method != 0:
+      raise SimplePngError("unsupported filter method: {}".format(filter_method))
+    self.width = width
+    self.height = height
+    self.bit_depth = bit_depth
+    self.color_type = color_type
+    self.interlaced = interlaced
+
+    if bit_depth not in readable_bit_depths.get(color_type, ()):
+      raise SimplePngError("unsupported color type/bit depth combination: {}/{}".format(color_type, bit_depth))
+    self.bits_per_pixel = channel_counts[color_type] * bit_depth
+    self.filter_left_delta = max(1, self.bits_per_pixel // 8)
+
+    if interlaced == 0:
+      interlacing = no_interlacing
+    elif interlaced == 1:
+      interlacing = adam7_interlacing
     else:
-      if verbose: print("WARNING: ignoring chunk: " + repr(chunk.type_code))
-  idat_accumulator.append(decompressor.flush())
-  idat_data = list(b"".join(idat_accumulator))
-  if len(idat_data) != expected_idat_data_len:
-    raise SimplePngError("unexpected decoded IDAT data length. expected: {}. got: {}".format(expected_idat_data_len, len(idat_data)))
-
-  image = ImageBuffer(width, height)
-  data = image.data
-
-  # decode the pixels
-  if verbose: filter_type_histogram = collections.Counter()
-  in_cursor = 0
-  out_cursor = 0
-  for pass_index in range(len(interlacing)):
-    x_scale, x_offset, y_scale, y_offset = interlacing[pass_index]
-    pass_width, pass_height = pixel_sizes[pass_index]
-    scanline_length = scanline_lengths[pass_index]
-    scanline_content_length = scanline_length - 1
-    if pass_width == 0: continue
-
-    for y in range(pass_height):
-      filter_type = idat_data[in_cursor]
-      in_cursor += 1
-      if verbose: filter_type_histogram.update([filter_type])
-
-      # apply filter to the scanline
-      if filter_type == 0: # none
-        pass
-      elif filter_type == 1: # sub
-        for i in range(filter_left_delta, scanline_content_length):
-          idat_data[in_cursor + i] = (
-            idat_data[in_cursor + i] +
-            idat_data[in_cursor + i - filter_left_delta]
-          ) & 0xff
-      elif filter_type == 2: # up
-        if y == 0:
-          pass
-        else:
-          for i in range(0, scanline_content_length):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              idat_data[in_cursor - scanline_length + i]
-            ) & 0xff
-      elif filter_type == 3: # average
-        if y == 0:
-          for i in range(filter_left_delta, scanline_content_length):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              (idat_data[in_cursor + i - filter_left_delta] >> 1)
-            ) & 0xff
+      raise SimplePngError("unsupported interlace method: {}".format(interlaced))
+    self.interlacing = interlacing
+
+    self.pixel_sizes = [(
+      (width  + x_scale - x_offset - 1) // x_scale,
+      (height + y_scale - y_offset - 1) // y_scale,
+    ) for (x_scale, x_offset, y_scale, y_offset) in interlacing]
+    # make sure all pixels are accounted for
+    assert width * height == sum(w * h for (w, h) in self.pixel_sizes)
+
+    self.scanline_lengths = [
+      # filter types are present only for >0 width subimages
+      int(bool(w)) + (w * self.bits_per_pixel + 7) // 8
+      for (w, _) in self.pixel_sizes
+    ]
+    self.expected_idat_data_len = sum(scanline_length * h for (scanline_length, (_, h)) in zip(self.scanline_lengths, self.pixel_sizes))
+
+    self.palette = None
+    self.trns = None
+    self.filter_type_histogram = collections.Counter()
+    self.pixel_table = None
+
+  def iter_idat_data(self):
+    # reads the rest of the chunks, yielding the decompressed IDAT data in bounded pieces.
+    f = self.f
+    verbose = self.verbose
+    stats = self.stats
+    color_type = self.color_type
+    decompressor = zlib.decompressobj()
+    while True:
+      start = time.perf_counter()
+      length, type_code = read_chunk_header(f)
+      stats.bytes_in += 12 + length
+      stats.count_chunk(type_code, length)
+      if type_code == b"IDAT" and not isinstance(f, BufferReader):
+        # don't read a whole IDAT chunk into memory from a file.
+        # from a buffer, the body is a view of it, which costs nothing.
+        stats.add_time("read", start)
+        yield from self.inflate(decompressor, iter_chunk_body(f, length, decompress_piece_size, stats))
+        continue
+      chunk = Chunk(type_code, read_chunk_body(f, length))
+      stats.add_time("read", start)
+      if chunk.type_code == b"IEND":
+        if len(f.read(1)) != 0:
+          raise SimplePngError("expected EOF")
+        break
+      elif chunk.type_code == b"PLTE":
+        if color_type & color_type_mask_INDEXED:
+          if self.palette != None:
+            raise SimplePngError("multiple PLTE chunks")
+          if len(chunk.body) == 0:
+            raise SimplePngError("empty PLTE chunk")
+          if len(chunk.body) % 3 != 0:
+            raise SimplePngError("PLTE chunk length must be a multiple of 3")
+          self.palette = [struct.unpack("!I", bytes(rgb + (0xff,)))[0] for rgb in zip(*[iter(chunk.body)]*3)]
         else:
-          for i in range(0, filter_left_delta):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              (idat_data[in_cursor - scanline_length + i] >> 1)
-            ) & 0xff
-          for i in range(filter_left_delta, scanline_content_length):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] + ((
-                idat_data[in_cursor + i - filter_left_delta] +
-                idat_data[in_cursor - scanline_length + i]
-              ) >> 1)
-            ) & 0xff
-      elif filter_type == 4: # paeth
-        if y == 0:
-          for i in range(filter_left_delta, scanline_content_length):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              get_paeth_predictor(
-                idat_data[in_cursor + i - filter_left_delta],
-                0,
-                0,
-              )
-            ) & 0xff
+          if verbose: print("WARNING: ignoring PLTE chunk. color_type {} does not require a palette".format(color_type))
+      elif chunk.type_code == b"tRNS":
+        if color_type & color_type_mask_ALPHA:
+          raise SimplePngError("tRNS chunk not allowed for color type: {}".format(color_type))
+        if color_type & color_type_mask_INDEXED:
+          palette = self.palette
+          if palette == None:
+            raise SimplePngError("tRNS must come after PLTE")
+          if len(chunk.body) > len(palette):
+            raise SimplePngError("too many tRNS values. {} > {}".format(len(chunk.body), len(palette)))
+          for i in range(len(chunk.body)):
+            palette[i] = (palette[i] & 0xffffff00) | chunk.body[i]
         else:
-          for i in range(0, filter_left_delta):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              get_paeth_predictor(
-                0,
-                idat_data[in_cursor - scanline_length + i],
-                0,
-              )
-            ) & 0xff
-          for i in range(filter_left_delta, scanline_content_length):
-            idat_data[in_cursor + i] = (
-              idat_data[in_cursor + i] +
-              get_paeth_predictor(
-                idat_data[in_cursor + i - filter_left_delta],
-                idat_data[in_cursor - scanline_length + i],
-                idat_data[in_cursor - scanline_length + i - filter_left_delta],
-              )
-            ) & 0xff
+          if color_type & color_type_mask_COLOR:
+            expected_trns_length = 6
+          else:
+            expected_trns_length = 2
+          if len(chunk.body) != expected_trns_length:
+            raise SimplePngError("expected tRNS length {}. got: {}".format(expected_trns_length, len(chunk.body)))
+          self.trns = bytes(chunk.body)
+      elif chunk.type_code == b"IDAT":
+        body = chunk.body
+        yield from self.inflate(decompressor, (body[i : i + decompress_piece_size] for i in range(0, len(body), decompress_piece_size)))
       else:
-        raise SimplePngError("unrecognized filter type: {}".format(filter_type))
-
-      # now we can read the pixel colors from the bytes
-      bit_index = 0
-      for x in range(pass_width):
-        value = read_color(idat_data, in_cursor, bit_index)
-        bit_index += bits_per_pixel
-        if palette != None:
+        if verbose: print("WARNING: ignoring chunk: " + repr(chunk.type_code))
+      # don't keep a view of the file around
+      chunk.body.release()
+    try:
+      yield decompressor.flush()
+    except zlib.error as e:
+      raise SimplePngError("corrupt IDAT data: {}".format(e))
+
+  def inflate(self, decompressor, pieces):
+    # feed the decompressor bounded pieces, so that unconsumed_tail never copies much
+    if (self.color_type & color_type_mask_INDEXED) and self.palette == None:
+      raise SimplePngError("missing PLTE chunk")
+    stats = self.stats
+    for data in pieces:
+      while len(data) > 0:
+        start = time.perf_counter()
+        try:
+          piece = decompressor.decompress(data, decompress_piece_size)
+        except zlib.error as e:
+          raise SimplePngError("corrupt IDAT data: {}".format(e))
+        stats.add_time("inflate", start)
+        yield piece
+        data = decompressor.unconsumed_tail
+
+  def iter_scanlines(self):
+    # yields (pass_index, y, scanline) for every unfiltered scanline, not including the filter type byte.
+    # only the previous scanline is kept around for reversing the filters.
+    pieces = self.iter_idat_data()
+    filter_type_histogram = self.filter_type_histogram
+    filter_left_delta = self.filter_left_delta
+    stats = self.stats
+    buffer = bytearray()
+    cursor = 0
+    consumed = 0
+    for pass_index, (pass_width, pass_height) in enumerate(self.pixel_sizes):
+      if pass_width == 0: continue
+      scanline_length = self.scanline_lengths[pass_index]
+      previous = None
+      for y in range(pass_height):
+        while len(buffer) - cursor < scanline_length:
+          del buffer[:cursor]
+          cursor = 0
           try:
-            value = palette[value]
-          except IndexError:
-            raise SimplePngError("color index out of bounds: {} >= {}".format(value, len(palette)))
-        if interlaced == 0:
-          data[out_cursor] = value
-          out_cursor += 1
-        else:
-          data[(y * y_scale + y_offset) * width + x * x_scale + x_offset] = value
+            buffer += next(pieces)
+          except StopIteration:
+            raise SimplePngError("unexpected decoded IDAT data length. expected: {}. got: {}".format(self.expected_idat_data_len, consumed + len(buffer)))
+        filter_type = buffer[cursor]
+        filter_type_histogram[filter_type] += 1
+        scanline = buffer[cursor + 1 : cursor + scanline_length]
+        cursor += scanline_length
+        consumed += scanline_length
+        start = time.perf_counter()
+        previous = unfilter_scanline(filter_type, scanline, previous, filter_left_delta)
+        stats.add_time("unfilter", start)
+        yield pass_index, y, previous
+    # read to the end of the file, and make sure there's no extra data
+    extra = len(buffer) - cursor + sum(len(piece) for piece in pieces)
+    if extra != 0:
+      raise SimplePngError("unexpected decoded IDAT data length. expected: {}. got: {}".format(self.expected_idat_data_len, consumed + extra))
+
+  def convert_rows(self, rows, pass_width, row_count):
+    # rows is row_count unfiltered scanlines concatenated together.
+    # returns an array of the 0xRRGGBBAA values for all the pixels.
+    if numpy != None:
+      rows = numpy.frombuffer(rows, numpy.uint8).reshape(row_count, -1)
+      values = numpy_unpack_pixels(rows, pass_width, self.color_type, self.bit_depth, self.palette, self.trns)
+      return array(pixel_typecode, values.astype(numpy.uint32).tobytes())
+    return row_converters[(self.color_type, self.bit_depth, self.trns != None)](self, rows, pass_width, row_count)
+
+  def convert_packed_rows(self, rows, pass_width, row_count):
+    # one table lookup per byte of the scanline expands all the pixels packed into it
+    pixel_table = self.get_pixel_table()
+    palette = self.palette
+    check_indexes = palette != None and len(palette) < 1 << self.bit_depth
+    out = array(pixel_typecode)
+    rows = memoryview(rows)
+    scanline_content_length = len(rows) // row_count
+    for scanline_start in range(0, len(rows), scanline_content_length):
+      scanline = rows[scanline_start : scanline_start + scanline_content_length]
+      if check_indexes:
+        # ignoring the padding bits at the end of the scanline
+        indexes = b"".join(map(self.index_table.__getitem__, scanline))[:pass_width]
+        max_index = max(indexes)
+        if max_index >= len(palette):
+          raise SimplePngError("color index out of bounds: {} >= {}".format(max_index, len(palette)))
+      out.frombytes(b"".join(map(pixel_table.__getitem__, scanline))[:pass_width * 4])
+    return out
+
+  def get_pixel_table(self):
+    # for grayscale and palette images up to 8 bits, maps each byte of a scanline
+    # to the native-endian pixel values of all the samples packed into it, with tRNS already applied.
+    if self.pixel_table != None:
+      return self.pixel_table
+    bit_depth = self.bit_depth
+    sample_count = 1 << bit_depth
+    if self.palette != None:
+      # out of bounds indexes are checked separately
+      colors = (self.palette + [0] * sample_count)[:sample_count]
+    else:
+      scale = 0xff // (sample_count - 1)
+      colors = [(sample * scale * 0x01010100) | 0xff for sample in range(sample_count)]
+      if self.trns != None and self.trns[1] < sample_count:
+        colors[self.trns[1]] = 0
+    samples_per_byte = 8 // bit_depth
+    self.index_table = []
+    self.pixel_table = []
+    for byte in range(0x100):
+      samples = [(byte >> (8 - bit_depth * (i + 1))) & (sample_count - 1) for i in range(samples_per_byte)]
+      self.index_table.append(bytes(samples))
+      self.pixel_table.append(array(pixel_typecode, [colors[sample] for sample in samples]).tobytes())
+    return self.pixel_table
+
+  def read_image(self, region=None, progress=None, max_pass=None):
+    pass_count = len(self.interlacing)
+    if max_pass != None:
+      if max_pass < 1:
+        raise SimplePngError("max_pass must be at least 1. got: {}".format(max_pass))
+      pass_count = min(pass_count, max_pass)
+    if region == None:
+      rx, ry, width, height = 0, 0, self.width, self.height
+    else:
+      if progress != None or pass_count < len(self.interlacing):
+        raise SimplePngError("region can't be combined with progress or max_pass")
+      rx, ry, width, height = region
+      if width <= 0 or height <= 0 or rx < 0 or ry < 0 or rx + width > self.width or ry + height > self.height:
+        raise SimplePngError("region {} is not within the {}x{} image".format(tuple(region), self.width, self.height))
+    image = ImageBuffer(width, height)
+    data = image.data
+    bits_per_pixel = self.bits_per_pixel
+    # for each pass: (first column, column count, first row, row count) of the pass's pixels in the region
+    pass_regions = []
+    for (x_scale, x_offset, y_scale, y_offset), (pass_width, pass_height) in zip(self.interlacing, self.pixel_sizes):
+      px = max(0, -((x_offset - rx) // x_scale))
+      py = max(0, -((y_offset - ry) // y_scale))
+      pass_regions.append((
+        px, min(pass_width, -((x_offset - rx - width) // x_scale)) - px,
+        py, min(pass_height, -((y_offset - ry - height) // y_scale)) - py,
+      ))
+    remaining_rows = sum(h for (_, w, _, h) in pass_regions if w > 0)
+    pass_blocks = adam7_pass_blocks if self.interlaced else [(1, 1)]
+    finished_passes = 0
+    pass_rows = bytearray()
+    scanlines = self.iter_scanlines()
+    for pass_index, y, scanline in scanlines:
+      px, pw, py, ph = pass_regions[pass_index]
+      if pw <= 0 or not (py <= y < py + ph): continue
+      # only the bytes holding the region's columns
+      pass_rows += scanline[px * bits_per_pixel // 8 : ((px + pw) * bits_per_pixel + 7) // 8]
+      remaining_rows -= 1
+      if y < py + ph - 1: continue
+      # convert a whole pass at a time.
+      # below 8 bits per pixel, the first byte can have pixels left of the region.
+      start = time.perf_counter()
+      skip = px * bits_per_pixel % 8 // bits_per_pixel
+      values = self.convert_rows(pass_rows, skip + pw, ph)
+      pass_rows = bytearray()
+      if self.interlaced == 0 and skip == 0:
+        data[:] = values
+      else:
+        x_scale, x_offset, y_scale, y_offset = self.interlacing[pass_index]
+        x_start = px * x_scale + x_offset - rx
+        for y in range(ph):
+          row_start = ((py + y) * y_scale + y_offset - ry) * width
+          values_start = y * (skip + pw) + skip
+          data[row_start + x_start : row_start + width : x_scale] = values[values_start : values_start + pw]
+      self.stats.add_time("convert", start)
+      if region != None and remaining_rows == 0:
+        # don't inflate the rest of the image
+        scanlines.close()
+        break
+      # passes without any pixels finish along with the one before them
+      finished_passes = pass_index + 1
+      while finished_passes < pass_count and 0 in self.pixel_sizes[finished_passes]:
+        finished_passes += 1
+      if progress != None:
+        for pass_number in range(pass_index + 1, finished_passes + 1):
+          x_scale, y_scale = pass_blocks[pass_number - 1]
+          progress(pass_number, fill_blocks(keep_block_corners(image, x_scale, y_scale), x_scale, y_scale, width, height))
+      if finished_passes >= pass_count and pass_count < len(self.interlacing):
+        # don't inflate the later passes
+        scanlines.close()
+        break
+    self.print_filter_types()
+    if pass_count < len(self.interlacing):
+      x_scale, y_scale = pass_blocks[pass_count - 1]
+      image = keep_block_corners(image, x_scale, y_scale)
+    self.stats.bytes_out += 4 * len(image.data)
+    return image
+
+  def finish_stats(self):
+    self.stats.filter_type_histogram.update(self.filter_type_histogram)
+    self.stats.finish()
 
-      in_cursor += scanline_content_length
+  def print_filter_types(self):
+    if self.verbose: print("filter types used: " + "   ".join("{}:{}".format(*x) for x in sorted(self.filter_type_histogram.items())))
 
-  if verbose: print("filter types used: " + "   ".join("{}:{}".format(*x) for x in sorted(filter_type_histogram.items())))
+def keep_block_corners(image, x_scale, y_scale):
+  # returns an image with just the top left pixel of each x_scale by y_scale block
+  width = (image.width + x_scale - 1) // x_scale
+  height = (image.height + y_scale - 1) // y_scale
+  other = ImageBuffer(width, height)
+  for y in range(height):
+    row_start = y * y_scale * image.width
+    other.data[y * width : (y + 1) * width] = image.data[row_start : row_start + image.width : x_scale]
+  return other
+def fill_blocks(image, x_scale, y_scale, width, height):
+  # the reverse of keep_block_corners(): each pixel fills an x_scale by y_scale block
+  other = ImageBuffer(width, height)
+  row = array(pixel_typecode, [0]) * width
+  for y in range(image.height):
+    source_row = image.data[y * image.width : (y + 1) * image.width]
+    for x in range(x_scale):
+      row[x : : x_scale] = source_row[: len(range(x, width, x_scale))]
+    for row_y in range(y * y_scale, min(height, (y + 1) * y_scale)):
+      other.data[row_y * width : (row_y + 1) * width] = row
+  return other
+
+channel_counts = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+def numpy_unpack_pixels(rows, width, color_type, bit_depth, palette, trns):
+  # rows is a 2d uint8 array of unfiltered scanlines without their filter type bytes.
+  # returns a 2d uint32 array of 0xRRGGBBAA values.
+  height = rows.shape[0]
+  channels = channel_counts[color_type]
+  if bit_depth < 8:
+    bits = numpy.unpackbits(rows, axis=1).reshape(height, -1, bit_depth)
+    samples = bits.dot(1 << numpy.arange(bit_depth - 1, -1, -1, dtype=numpy.uint32))[:, :width, None]
+    # scale grayscale values up to 8 bits
+    high_bytes = samples * (0xff // ((1 << bit_depth) - 1))
+  elif bit_depth == 8:
+    samples = rows[:, :width * channels].reshape(height, width, channels).astype(numpy.uint32)
+    high_bytes = samples
+  else:
+    samples = rows[:, :width * channels * 2].reshape(height, width, channels, 2).astype(numpy.uint32)
+    high_bytes = samples[..., 0]
+    samples = (samples[..., 0] << 8) | samples[..., 1]
+
+  if color_type == 3:
+    indexes = samples[..., 0]
+    max_index = int(indexes.max())
+    if max_index >= len(palette):
+      raise SimplePngError("color index out of bounds: {} >= {}".format(max_index, len(palette)))
+    return numpy.array(palette, numpy.uint32)[indexes]
+
+  if color_type & color_type_mask_COLOR:
+    values = (high_bytes[..., 0] << 24) | (high_bytes[..., 1] << 16) | (high_bytes[..., 2] << 8)
+  else:
+    values = high_bytes[..., 0] * 0x01010100
+  if color_type & color_type_mask_ALPHA:
+    values |= high_bytes[..., -1]
+  else:
+    values |= 0xff
 
-  return image
+  if trns != None:
+    if bit_depth == 16:
+      key = [(trns[i] << 8) | trns[i + 1] for i in range(0, len(trns), 2)]
+    else:
+      key = [trns[i + 1] for i in range(0, len(trns), 2)]
+    values[(samples == numpy.array(key, numpy.uint32)).all(axis=-1)] = 0
+  return values
 
 no_interlacing = [
   (1, 0, 1, 0),
@@ -556,6 +1853,222 @@ adam7_interlacing = [
   (2, 1, 2, 0),
   (1, 0, 2, 1),
 ]
+# (x_scale, y_scale) of the blocks of pixels known after each pass
+adam7_pass_blocks = [
+  (8, 8),
+  (4, 8),
+  (4, 4),
+  (2, 4),
+  (2, 2),
+  (1, 2),
+  (1, 1),
+]
+
+def unfilter_scanline(filter_type, scanline, previous, filter_left_delta):
+  # scanline is a bytearray of filtered bytes, not including the filter type byte.
+  # previous is the already unfiltered scanline above, or None for the first scanline of a pass.
+  # returns the unfiltered bytes; scanline may be modified in place.
+  if filter_type == 0: # none
+    return scanline
+  if filter_type == 1: # sub
+    return add_bytes_prefix(scanline, filter_left_delta)
+  if filter_type == 2: # up
+    if previous == None:
+      return scanline
+    return add_bytes(scanline, previous)
+  if filter_type == 3: # average
+    # each byte depends on the one filter_left_delta to the left,
+    # so each channel is one sequential loop that keeps the left byte in a local.
+    if previous == None:
+      previous = bytes(len(scanline))
+    # the leftmost pixel's predictor is half the byte above
+    scanline[:filter_left_delta] = add_bytes(scanline[:filter_left_delta], previous[:filter_left_delta].translate(halve_table))
+    for channel in range(filter_left_delta):
+      a = scanline[channel]
+      out = []
+      append = out.append
+      for x, b in zip(scanline[channel + filter_left_delta :: filter_left_delta], previous[channel + filter_left_delta :: filter_left_delta]):
+        a = (x + ((a + b) >> 1)) & 0xff
+        append(a)
+      scanline[channel + filter_left_delta :: filter_left_delta] = bytes(out)
+    return scanline
+  if filter_type == 4: # paeth
+    if previous == None:
+      # the predictor is always the left byte, which is the same as sub
+      return add_bytes_prefix(scanline, filter_left_delta)
+    # the predictor for the leftmost pixel is always the byte above, which is the same as up
+    scanline[:filter_left_delta] = add_bytes(scanline[:filter_left_delta], previous[:filter_left_delta])
+    # get_paeth_predictor() inlined, with what only depends on the previous scanline done for the whole row first:
+    # with p = a + b - c, pa = |b - c|, pb = |a - c|, and pc = |(a - c) + (b - c)|.
+    b_minus_c, pa_values = get_paeth_previous_terms(previous, filter_left_delta)
+    for channel in range(filter_left_delta):
+      a = scanline[channel]
+      c = previous[channel]
+      out = []
+      append = out.append
+      for x, b, bc, pa in zip(scanline[channel + filter_left_delta :: filter_left_delta], previous[channel + filter_left_delta :: filter_left_delta],
+          b_minus_c[channel :: filter_left_delta], pa_values[channel :: filter_left_delta]):
+        ac = a - c
+        pb = abs(ac)
+        pc = abs(ac + bc)
+        if pa <= pb and pa <= pc:
+          a = (x + a) & 0xff
+        elif pb <= pc:
+          a = (x + b) & 0xff
+        else:
+          a = (x + c) & 0xff
+        append(a)
+        c = b
+      scanline[channel + filter_left_delta :: filter_left_delta] = bytes(out)
+    return scanline
+  raise SimplePngError("unrecognized filter type: {}".format(filter_type))
+
+halve_table = bytes(value >> 1 for value in range(0x100))
+def get_paeth_previous_terms(previous, filter_left_delta):
+  # returns lists of b - c and |b - c| for each byte after the first pixel,
+  # where b is the byte above and c is the byte above and to the left.
+  if numpy != None:
+    above = numpy.frombuffer(previous, numpy.uint8).astype(numpy.int16)
+    b_minus_c = above[filter_left_delta:] - above[:-filter_left_delta]
+    return b_minus_c.tolist(), numpy.abs(b_minus_c).tolist()
+  b_minus_c = list(map(operator.sub, previous[filter_left_delta:], previous))
+  return b_minus_c, list(map(abs, b_minus_c))
+
+# the following functions treat a whole row of bytes as one big integer
+# and do bytewise arithmetic modulo 256 on all of them at once.
+byte_masks_cache = {}
+def get_byte_masks(length):
+  try:
+    return byte_masks_cache[length]
+  except KeyError:
+    pass
+  high_bits = int.from_bytes(b"\x80" * length, "little")
+  all_bits = (1 << (8 * length)) - 1
+  masks = byte_masks_cache[length] = (high_bits, all_bits ^ high_bits, all_bits)
+  return masks
+def add_bytes_int(x, y, high_bits, low_bits):
+  # add the low 7 bits of each byte without carrying into the next byte, then fix up the high bits
+  return ((x & low_bits) + (y & low_bits)) ^ ((x ^ y) & high_bits)
+def subtract_bytes_int(x, y, high_bits, low_bits):
+  # borrowing into the high bit of each byte never borrows from the next byte
+  return ((x | high_bits) - (y & low_bits)) ^ ((x ^ ~y) & high_bits)
+def add_bytes(a, b):
+  # returns bytes where each byte is (a[i] + b[i]) & 0xff
+  length = len(a)
+  high_bits, low_bits, _ = get_byte_masks(length)
+  x = add_bytes_int(int.from_bytes(a, "little"), int.from_bytes(b, "little"), high_bits, low_bits)
+  return x.to_bytes(length, "little")
+def add_bytes_prefix(a, delta):
+  # returns bytes where each byte is (a[i] + result[i - delta]) & 0xff,
+  # computed as a parallel prefix sum in log(len(a) / delta) steps.
+  length = len(a)
+  high_bits, low_bits, all_bits = get_byte_masks(length)
+  x = int.from_bytes(a, "little")
+  shift = delta
+  while shift < length:
+    x = add_bytes_int(x, (x << (8 * shift)) & all_bits, high_bits, low_bits)
+    shift *= 2
+  return x.to_bytes(length, "little")
+
+# pure python conversions from whole unfiltered scanlines to pixel values.
+# these take (decoder, rows, pass_width, row_count), where rows is row_count scanlines concatenated together.
+# at 8 and 16 bits per sample there are no padding bits, so all the rows are converted at once.
+def convert_rgba8_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(rows)
+def convert_rgba16_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(rows[0::2])
+def convert_rgb8_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(rgb_to_rgba(rows))
+def convert_rgb8_trns_rows(decoder, rows, pass_width, row_count):
+  values = convert_rgb8_rows(decoder, rows, pass_width, row_count)
+  trns = decoder.trns
+  replace_values(values, (trns[1] << 24) | (trns[3] << 16) | (trns[5] << 8) | 0xff, 0)
+  return values
+def convert_rgb16_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(rgb_to_rgba(rows[0::2]))
+def convert_rgb16_trns_rows(decoder, rows, pass_width, row_count):
+  values = convert_rgb16_rows(decoder, rows, pass_width, row_count)
+  trns = decoder.trns
+  clear_16_bit_key(values, rows, trns, (trns[0] << 24) | (trns[2] << 16) | (trns[4] << 8) | 0xff)
+  return values
+def convert_gray16_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(gray_alpha_to_rgba(rows[0::2], None))
+def convert_gray16_trns_rows(decoder, rows, pass_width, row_count):
+  values = convert_gray16_rows(decoder, rows, pass_width, row_count)
+  trns = decoder.trns
+  clear_16_bit_key(values, rows, trns, (trns[0] * 0x01010100) | 0xff)
+  return values
+def convert_gray_alpha8_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(gray_alpha_to_rgba(rows[0::2], rows[1::2]))
+def convert_gray_alpha16_rows(decoder, rows, pass_width, row_count):
+  return rgba_to_pixels(gray_alpha_to_rgba(rows[0::4], rows[2::4]))
+
+def rgba_to_pixels(rgba):
+  values = array(pixel_typecode)
+  values.frombytes(rgba)
+  if sys.byteorder == "little":
+    values.byteswap()
+  return values
+def rgb_to_rgba(rgb):
+  rgba = bytearray(b"\xff") * (len(rgb) // 3 * 4)
+  rgba[0::4] = rgb[0::3]
+  rgba[1::4] = rgb[1::3]
+  rgba[2::4] = rgb[2::3]
+  return rgba
+def gray_alpha_to_rgba(gray, alpha):
+  rgba = bytearray(b"\xff") * (len(gray) * 4)
+  rgba[0::4] = gray
+  rgba[1::4] = gray
+  rgba[2::4] = gray
+  if alpha != None:
+    rgba[3::4] = alpha
+  return rgba
+def replace_values(values, old, new):
+  try:
+    i = values.index(old)
+    while True:
+      values[i] = new
+      i = values.index(old, i + 1)
+  except ValueError:
+    pass
+def clear_16_bit_key(values, rows, key, key_value):
+  # pixels that match key_value in their most significant bytes are transparent if all 16 bits match the key
+  bytes_per_pixel = len(key)
+  try:
+    i = values.index(key_value)
+    while True:
+      if rows[i * bytes_per_pixel : (i + 1) * bytes_per_pixel] == key:
+        values[i] = 0
+      i = values.index(key_value, i + 1)
+  except ValueError:
+    pass
+
+readable_bit_depths = {
+  0: (1, 2, 4, 8, 16),
+  2: (8, 16),
+  3: (1, 2, 4, 8),
+  4: (8, 16),
+  6: (8, 16),
+}
+
+row_converters = {}
+for bit_depth in (1, 2, 4, 8):
+  for has_trns in (False, True):
+    # tRNS is built into the lookup table for grayscale, and into the palette for indexed color
+    row_converters[(0, bit_depth, has_trns)] = PngDecoder.convert_packed_rows
+    row_converters[(3, bit_depth, has_trns)] = PngDecoder.convert_packed_rows
+row_converters.update({
+  (0, 16, False): convert_gray16_rows,
+  (0, 16, True): convert_gray16_trns_rows,
+  (2, 8, False): convert_rgb8_rows,
+  (2, 8, True): convert_rgb8_trns_rows,
+  (2, 16, False): convert_rgb16_rows,
+  (2, 16, True): convert_rgb16_trns_rows,
+  (4, 8, False): convert_gray_alpha8_rows,
+  (4, 16, False): convert_gray_alpha16_rows,
+  (6, 8, False): convert_rgba8_rows,
+  (6, 16, False): convert_rgba16_rows,
+})
 
 def get_paeth_predictor(a, b, c):
   p = a + b - c
@@ -566,28 +2079,119 @@ def get_paeth_predictor(a, b, c):
   if pb <= pc: return b
   return c
 
-def make_simple_grayscale_make_read_color_for_trns(value_multiplier, original_read_color):
-  def make_read_color_for_trns(trns_body):
-    magic_value = (
-      trns_body[1] * value_multiplier
-    ) | 0xff
-    def read_color(*args):
-      nominal_value = original_read_color(*args)
-      if nominal_value == magic_value: return 0
-      return nominal_value
-    return read_color
-  return make_read_color_for_trns
+def composite_files(input_paths, output_path, verbose=False, cache=None):
+  # pastes each image onto the first one, and writes the result.
+  # inputs are read through cache if given.
+  images = []
+  for input_path in input_paths:
+    if cache != None:
+      # flatten() doesn't change its inputs
+      images.append(cache.read_png(input_path, verbose=verbose, shared=True))
+      continue
+    with open(input_path, "rb") as f:
+      images.append(read_png(f, verbose=verbose))
+  image = flatten([(layer, (0, 0), False, 0) for layer in images[1:]], background=images[0])
+  with open(output_path, "wb") as f:
+    write_png(f, image)
+
+def run_batch_job(job):
+  # returns (job, seconds, error message or None)
+  input_paths, output_path = job
+  start_time = time.time()
+  try:
+    composite_files(input_paths, output_path, cache=batch_cache)
+    error = None
+  except Exception as e:
+    # anything that goes wrong with one job is reported, and the rest of the batch goes on
+    error = "{}: {}".format(type(e).__name__, e)
+  return job, time.time() - start_time, error
+
+# each batch worker process keeps the layers it has read, since jobs often share them.
+# run_batch() splits its cache_bytes between the workers.
+batch_cache = PngCache()
+def init_batch_worker(cache_bytes):
+  batch_cache.max_bytes = cache_bytes
+
+def read_batch_manifest(path):
+  # each line is a job: the input files to composite in order, followed by the output file.
+  # paths are relative to the manifest's directory. # starts a comment.
+  base_dir = os.path.dirname(path)
+  jobs = []
+  with open(path) as f:
+    for line_number, line in enumerate(f, 1):
+      paths = [os.path.join(base_dir, p) for p in shlex.split(line, comments=True)]
+      if len(paths) == 0: continue
+      if len(paths) < 2:
+        raise SimplePngError("{}:{}: expected at least one input and an output".format(path, line_number))
+      jobs.append((paths[:-1], paths[-1]))
+  return jobs
+
+def find_batch_jobs(path):
+  # each subdirectory is a job: its png files composited in order of name into <subdirectory>.png
+  jobs = []
+  for name in sorted(os.listdir(path)):
+    job_dir = os.path.join(path, name)
+    if not os.path.isdir(job_dir): continue
+    input_paths = [os.path.join(job_dir, n) for n in sorted(os.listdir(job_dir)) if n.lower().endswith(".png")]
+    if len(input_paths) == 0: continue
+    jobs.append((input_paths, job_dir + ".png"))
+  return jobs
+
+def run_batch(jobs, processes=None, out=sys.stdout, cache_bytes=0x10000000):
+  # runs the jobs in a process pool, reporting progress as they finish.
+  # cache_bytes is the most decoded pixel data kept by all the workers together.
+  # returns the number of jobs that failed.
+  if processes != None and processes < 1:
+    raise SimplePngError("processes must be positive. got: {}".format(processes))
+  failures = 0
+  start_time = time.time()
+  worker_count = processes if processes != None else (os.cpu_count() or 1)
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+      initializer=init_batch_worker, initargs=(cache_bytes // worker_count,)) as executor:
+    futures = [executor.submit(run_batch_job, job) for job in jobs]
+    for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+      (_, output_path), seconds, error = future.result()
+      if error == None:
+        print("[{}/{}] {}: {:.3f}s".format(done_count, len(jobs), output_path, seconds), file=out)
+      else:
+        failures += 1
+        print("[{}/{}] {}: FAILED: {}".format(done_count, len(jobs), output_path, error), file=out)
+  print("{} jobs, {} failed, {:.3f}s".format(len(jobs), failures, time.time() - start_time), file=out)
+  return failures
+
+def batch_main(args):
+  usage = "usage: simplepng.py --batch (MANIFEST | DIRECTORY) [--processes N] [--cache-mb N]"
+  if len(args) % 2 != 1:
+    sys.exit(usage)
+  options = {"--processes": None, "--cache-mb": 256}
+  for name, value in zip(args[1::2], args[2::2]):
+    if name not in options or not value.isdigit():
+      sys.exit(usage)
+    options[name] = int(value)
+  if options["--processes"] == 0:
+    sys.exit(usage)
+  if os.path.isdir(args[0]):
+    jobs = find_batch_jobs(args[0])
+  else:
+    jobs = read_batch_manifest(args[0])
+  if run_batch(jobs, options["--processes"], cache_bytes=options["--cache-mb"] << 20) != 0:
+    sys.exit(1)
 
 if __name__ == "__main__":
+  if sys.argv[1:2] == ["--batch"]:
+    batch_main(sys.argv[2:])
+    sys.exit()
   print("reading base...")
   with open(sys.argv[1], "rb") as f:
     image1 = read_png(f, verbose=True)
+  layers = []
   for arg in sys.argv[2:-1]:
     print("reading {}...".format(arg))
     with open(arg, "rb") as f:
-      image2 = read_png(f, verbose=True)
+      layers.append((read_png(f, verbose=True), (0, 0), False, 0))
+  if len(layers) > 0:
     print("compositing...")
-    image1.paste(image2, 0, 0, 0, 0)
+    image1 = flatten(layers, background=image1)
   if len(sys.argv) >= 3:
     print("writing...")
     with open(sys.argv[-1], "wb") as f:
@@ -1,8 +1,17 @@
 
 import os
 import sys
+import io
 import itertools
+import gc
+import time
+import asyncio
+import concurrent.futures
+import random
+import zlib
 import shutil
+import tempfile
+import tracemalloc
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import simplepng
@@ -299,7 +308,914 @@ def test_schaik_expectation(names, expected_name):
       try: os.remove(name)
       except OSError: pass
 
+def test_image_buffer_storage():
+  image = simplepng.ImageBuffer(3, 2)
+  assert memoryview(image.data).itemsize == 4
+  image.set(2, 1, 0x11223344)
+  assert image.at(2, 1) == 0x11223344
+  row = image.row(1)
+  assert list(row) == [0, 0, 0x11223344]
+  row[0] = 0xffffffff
+  assert image.at(0, 1) == 0xffffffff
+  assert [list(r) for r in image.rows()] == [[0, 0, 0], [0xffffffff, 0, 0x11223344]]
+  if sys.version_info >= (3, 12):
+    assert memoryview(image)[3] == 0xffffffff
+
+def test_unfilter_scanline():
+  def reference_unfilter(filter_type, scanline, previous, delta):
+    out = list(scanline)
+    if previous == None: previous = bytes(len(scanline))
+    for i in range(len(out)):
+      a = out[i - delta] if i >= delta else 0
+      b = previous[i]
+      c = previous[i - delta] if i >= delta else 0
+      predictor = [0, a, b, (a + b) >> 1, simplepng.get_paeth_predictor(a, b, c)][filter_type]
+      out[i] = (out[i] + predictor) & 0xff
+    return bytes(out)
+  rng = random.Random(0)
+  for delta in (1, 2, 3, 4, 6, 8):
+    for length in (delta, delta * 5, delta * 37):
+      previous = bytes(rng.randrange(256) for _ in range(length))
+      scanline = bytes(rng.randrange(256) for _ in range(length))
+      for filter_type in range(5):
+        for p in (None, previous):
+          got = simplepng.unfilter_scanline(filter_type, bytearray(scanline), p, delta)
+          assert bytes(got) == reference_unfilter(filter_type, scanline, p, delta), (filter_type, delta, length)
+          filtered = simplepng.filter_scanline(filter_type, scanline, p, delta)
+          assert bytes(simplepng.unfilter_scanline(filter_type, bytearray(filtered), p, delta)) == scanline, (filter_type, delta, length)
+
+def all_schaik_decodable_names():
+  return itertools.chain(
+    schaik_basic_names,
+    schaik_interlaced_names,
+    schaik_filter_type_names,
+    schaik_background_names,
+    schaik_pallet_names,
+    schaik_odd_size_names,
+    schaik_transparency_names,
+  )
+
+def read_without_numpy(path):
+  numpy = simplepng.numpy
+  simplepng.numpy = None
+  try:
+    return simplepng.read_png(path)
+  finally:
+    simplepng.numpy = numpy
+
+def test_numpy_backend():
+  if simplepng.numpy == None:
+    return
+  for name in all_schaik_decodable_names():
+    path = os.path.join(schaik_dir, name)
+    with open(path, "rb") as f:
+      got_image = simplepng.read_png(f)
+    assert got_image.data == read_without_numpy(path).data, name
+
+  pixels = simplepng.numpy.arange(2 * 3 * 4, dtype=simplepng.numpy.uint8).reshape(2, 3, 4)
+  image = simplepng.ImageBuffer.from_array(pixels)
+  assert image.at(1, 0) == 0x04050607
+  view = image.to_array()
+  assert (view == pixels).all()
+  view[1, 2] = (0xff, 0xee, 0xdd, 0xcc)
+  assert image.at(2, 1) == 0xffeeddcc
+
+  rng = random.Random(0)
+  foreground = [rng.randrange(1 << 32) for _ in range(1000)]
+  background = [rng.randrange(1 << 32) for _ in range(1000)]
+  got = simplepng.numpy_alpha_blend(simplepng.numpy.array(foreground, simplepng.numpy.uint32), simplepng.numpy.array(background, simplepng.numpy.uint32))
+  expected = [simplepng.alpha_blend(f, b) for f, b in zip(foreground, background)]
+  assert got.tolist() == expected
+
+  with open(os.path.join(schaik_expected_dir, "t.png"), "rb") as f:
+    image = simplepng.read_png(f)
+  encoded = io.BytesIO()
+  simplepng.write_png(encoded, image)
+  numpy = simplepng.numpy
+  simplepng.numpy = None
+  try:
+    expected_encoded = io.BytesIO()
+    simplepng.write_png(expected_encoded, image)
+  finally:
+    simplepng.numpy = numpy
+  assert encoded.getvalue() == expected_encoded.getvalue()
+
+def test_iter_png_rows():
+  for name in all_schaik_decodable_names():
+    path = os.path.join(schaik_dir, name)
+    with open(path, "rb") as f:
+      expected_image = simplepng.read_png(f)
+    with open(path, "rb") as f:
+      rows = list(simplepng.iter_png_rows(f))
+    assert len(rows) == expected_image.height, name
+    for y, row in enumerate(rows):
+      assert list(row) == list(expected_image.row(y)), name
+  for name in schaik_error_names:
+    with open(os.path.join(schaik_dir, name), "rb") as f:
+      try:
+        for row in simplepng.iter_png_rows(f): pass
+      except simplepng.SimplePngError:
+        pass
+      else:
+        assert False, name + ": expected to throw"
+  # a single 4MiB IDAT chunk is read from a file a piece at a time
+  width, height = 64, 16000
+  raw = b"".join(b"\x00" + bytes((x + y) & 0xff for x in range(width * 4)) for y in range(height))
+  f = io.BytesIO()
+  f.write(simplepng.magic_number)
+  simplepng.Chunk(b"IHDR", simplepng.struct.pack(simplepng.IHDR_fmt, width, height, 8, 6, 0, 0, 0)).write_to(f)
+  simplepng.Chunk(b"IDAT", zlib.compress(raw, 0)).write_to(f)
+  simplepng.Chunk(b"IEND", b"").write_to(f)
+  f.seek(0)
+  tracemalloc.start()
+  try:
+    row_count = sum(1 for row in simplepng.iter_png_rows(f))
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  assert row_count == height
+  assert peak < len(raw) // 4, peak
+
+def count_chunks(png_bytes, type_code):
+  f = io.BytesIO(png_bytes)
+  f.read(len(simplepng.magic_number))
+  count = 0
+  while True:
+    chunk = simplepng.read_chunk(f)
+    if chunk.type_code == type_code: count += 1
+    if chunk.type_code == b"IEND": return count
+
+def test_png_writer():
+  with open(os.path.join(schaik_expected_dir, "bas.png"), "rb") as f:
+    expected_image = simplepng.read_png(f)
+  out = io.BytesIO()
+  with open(os.path.join(schaik_expected_dir, "bas.png"), "rb") as f:
+    with simplepng.PngWriter(out, expected_image.width, expected_image.height, chunk_size=100) as writer:
+      writer.write_rows(simplepng.iter_png_rows(f))
+  assert count_chunks(out.getvalue(), b"IDAT") > 1
+  out.seek(0)
+  assert simplepng.read_png(out).data == expected_image.data
+
+  writer = simplepng.PngWriter(io.BytesIO(), 2, 2)
+  writer.write_row([0, 0])
+  try:
+    writer.close()
+  except simplepng.SimplePngError:
+    pass
+  else:
+    assert False, "expected to throw"
+
+def test_filter_strategies():
+  with open(os.path.join(schaik_expected_dir, "bas.png"), "rb") as f:
+    image = simplepng.read_png(f)
+  sizes = {}
+  for filter_strategy in (0, 1, 2, 3, 4, "adaptive", "brute"):
+    out = io.BytesIO()
+    simplepng.write_png(out, image, filter_strategy=filter_strategy)
+    sizes[filter_strategy] = len(out.getvalue())
+    out.seek(0)
+    decoder = simplepng.PngDecoder(out)
+    assert decoder.read_image().data == image.data, filter_strategy
+    if filter_strategy in range(5):
+      assert list(decoder.filter_type_histogram) == [filter_strategy]
+  assert sizes["adaptive"] < sizes[1]
+  assert sizes["brute"] <= min(sizes[filter_type] for filter_type in range(5))
+
+def roundtrip(image, **kwargs):
+  out = io.BytesIO()
+  simplepng.write_png(out, image, **kwargs)
+  out.seek(0)
+  decoder = simplepng.PngDecoder(out)
+  got_image = decoder.read_image()
+  assert got_image.data == image.data
+  return decoder, len(out.getvalue())
+
+def test_optimize_color_type():
+  for name in all_schaik_decodable_names():
+    with open(os.path.join(schaik_dir, name), "rb") as f:
+      image = simplepng.read_png(f)
+    roundtrip(image)
+
+  def make_image(values, width=20):
+    image = simplepng.ImageBuffer(width, len(values) // width)
+    image.data[:] = simplepng.array(simplepng.pixel_typecode, values)
+    return image
+  rng = random.Random(0)
+  cases = [
+    # (pixel values, expected color type, expected bit depth)
+    ([0x000000ff, 0xffffffff] * 200, 0, 1),
+    ([0x000000ff, 0x555555ff, 0xaaaaaaff, 0xffffffff] * 100, 0, 2),
+    ([(0x111111 * i) << 8 | 0xff for i in range(16)] * 25, 0, 4),
+    ([0x000000ff, 0x0] * 200, 0, 1),
+    ([0x121212ff, 0x0] * 200, 3, 1),
+    ([(0x010101 * i) << 8 | 0xff for i in range(256)] * 5, 0, 8),
+    ([0x12121280, 0x0] * 200, 3, 1),
+    ([0x12345678, 0x0, 0xffffffff, 0x876543ff] * 100, 3, 2),
+    ([(0x010101 * rng.randrange(256)) << 8 | rng.randrange(256) for _ in range(400)], 4, 8),
+    ([(rng.randrange(1 << 24) << 8) | 0xff for _ in range(400)], 2, 8),
+    ([(rng.randrange(1 << 24) << 8) | 0xff for _ in range(399)] + [0], 2, 8),
+    ([rng.randrange(1 << 32) for _ in range(400)], 6, 8),
+  ]
+  for values, color_type, bit_depth in cases:
+    decoder, _ = roundtrip(make_image(values))
+    assert (decoder.color_type, decoder.bit_depth) == (color_type, bit_depth), (values[:4], decoder.color_type, decoder.bit_depth)
+  # empty images are an error before they're scanned
+  for width, height in [(0, 0), (0, 5), (5, 0)]:
+    for optimize_color_type in (True, False):
+      try:
+        simplepng.write_png(io.BytesIO(), simplepng.ImageBuffer(width, height), optimize_color_type=optimize_color_type)
+      except simplepng.SimplePngError:
+        pass
+      else:
+        assert False, "expected to throw"
+
+def test_parallel_deflate():
+  rng = random.Random(0)
+  a = bytes(rng.randrange(4) for _ in range(100000))
+  b = bytes(rng.randrange(256) for _ in range(70000))
+  assert simplepng.adler32_combine(simplepng.zlib.adler32(a), simplepng.zlib.adler32(b), len(b)) == simplepng.zlib.adler32(a + b)
+
+  with open(os.path.join(schaik_expected_dir, "bas.png"), "rb") as f:
+    image = simplepng.read_png(f)
+  parallel_block_size = simplepng.parallel_block_size
+  simplepng.parallel_block_size = 1000
+  try:
+    for threads in (2, 4):
+      out = io.BytesIO()
+      simplepng.write_png(out, image, threads=threads, optimize_color_type=False)
+      # decompressing checks the adler32 at the end of the zlib stream
+      out.seek(0)
+      assert simplepng.read_png(out).data == image.data
+  finally:
+    simplepng.parallel_block_size = parallel_block_size
+
+def test_batch():
+  with tempfile.TemporaryDirectory() as temp_dir:
+    manifest_path = os.path.join(temp_dir, "manifest.txt")
+    with open(manifest_path, "w") as f:
+      f.write("# base, sprite, output\n")
+      f.write("{} {} good.png\n".format(os.path.abspath(os.path.join(schaik_dir, "basn2c08.png")), os.path.abspath(os.path.join(schaik_dir, "basn6a08.png"))))
+      f.write("{} bad.png\n".format(os.path.abspath(os.path.join(schaik_dir, "xs1n0g01.png"))))
+      f.write("\n")
+      f.write("missing.png also_bad.png\n")
+      f.write("corrupt.png corrupt_out.png\n")
+    # garbage in the deflate stream, after the zlib header
+    with open(os.path.join(schaik_dir, "basn2c08.png"), "rb") as f:
+      data = bytearray(f.read())
+    idat = [chunk for chunk in simplepng.read_png_info(bytes(data)).chunks if chunk.type_code == b"IDAT"][0]
+    data[idat.offset + 10 : idat.offset + 30] = b"\xff" * 20
+    with open(os.path.join(temp_dir, "corrupt.png"), "wb") as f:
+      f.write(data)
+    try:
+      simplepng.read_png(bytes(data))
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+    jobs = simplepng.read_batch_manifest(manifest_path)
+    assert len(jobs) == 4
+    log = io.StringIO()
+    assert simplepng.run_batch(jobs, processes=2, out=log, cache_bytes=1 << 20) == 3, log.getvalue()
+    assert log.getvalue().count("FAILED") == 3
+    assert "corrupt IDAT data" in log.getvalue()
+    try:
+      simplepng.run_batch(jobs, processes=0, out=io.StringIO())
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+    expected_image = read_without_numpy(os.path.join(schaik_dir, "basn2c08.png"))
+    expected_image.paste(read_without_numpy(os.path.join(schaik_dir, "basn6a08.png")))
+    with open(os.path.join(temp_dir, "good.png"), "rb") as f:
+      assert simplepng.read_png(f).data == expected_image.data
+
+def test_read_png_info():
+  for name in itertools.chain(all_schaik_decodable_names(), schaik_ancillary_ignore_names):
+    path = os.path.join(schaik_dir, name)
+    with open(path, "rb") as f:
+      info = simplepng.read_png_info(f)
+    with open(path, "rb") as f:
+      decoder = simplepng.PngDecoder(f)
+      decoder.read_image()
+    assert (info.width, info.height, info.color_type, info.bit_depth, info.interlaced) == (
+      decoder.width, decoder.height, decoder.color_type, decoder.bit_depth, decoder.interlaced), name
+    if decoder.palette != None:
+      assert info.palette_size == len(decoder.palette), name
+    assert info.chunks[-1].type_code == b"IEND"
+    with open(path, "rb") as f:
+      data = f.read()
+    for chunk in info.chunks:
+      assert data[chunk.offset + 4 : chunk.offset + 8] == chunk.type_code
+    assert info.chunks[-1].offset + 12 == len(data)
+  with open(os.path.join(schaik_dir, "basn3p04.png"), "rb") as f:
+    truncated = f.read()[:-20]
+  try:
+    simplepng.read_png_info(io.BytesIO(truncated))
+  except simplepng.SimplePngError:
+    pass
+  else:
+    assert False, "expected to throw"
+
+def test_read_sources():
+  for name in all_schaik_decodable_names():
+    path = os.path.join(schaik_dir, name)
+    with open(path, "rb") as f:
+      data = f.read()
+    expected_data = simplepng.read_png(io.BytesIO(data)).data
+    for source in (path, data, bytearray(data), memoryview(data)):
+      assert simplepng.read_png(source).data == expected_data, (name, type(source))
+    assert [list(row) for row in simplepng.iter_png_rows(data)] == [list(row) for row in simplepng.iter_png_rows(path)]
+    assert len(simplepng.read_png_info(data).chunks) == len(simplepng.read_png_info(path).chunks)
+  # the memory map of a path is closed afterward, unless a slice of it is still around
+  for keep_slice in (False, True):
+    with simplepng.open_source(path) as reader:
+      mapped = reader.view.obj
+      piece = reader.read(8)
+      if not keep_slice:
+        piece.release()
+    assert mapped.closed != keep_slice
+    if keep_slice:
+      assert piece == simplepng.magic_number
+  for name in schaik_error_names:
+    with open(os.path.join(schaik_dir, name), "rb") as f:
+      data = f.read()
+    try:
+      simplepng.read_png(data)
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, name + ": expected to throw"
+
+def make_png(width, height, color_type, bit_depth, raw, extra_chunks=[], interlaced=0):
+  out = io.BytesIO()
+  out.write(simplepng.magic_number)
+  simplepng.Chunk(b"IHDR", simplepng.struct.pack(simplepng.IHDR_fmt, width, height, bit_depth, color_type, 0, 0, interlaced)).write_to(out)
+  for chunk in extra_chunks:
+    chunk.write_to(out)
+  simplepng.Chunk(b"IDAT", simplepng.zlib.compress(raw)).write_to(out)
+  simplepng.Chunk(b"IEND", b"").write_to(out)
+  return out.getvalue()
+
+def test_palette_index_bounds():
+  palette = simplepng.Chunk(b"PLTE", b"\x12\x34\x56")
+  # the padding bits after the 3 pixels are ignored
+  data = make_png(3, 1, 3, 1, b"\x00\x1f", [palette])
+  assert list(simplepng.read_png(data).data) == [0x123456ff] * 3
+  assert list(read_without_numpy(data).data) == [0x123456ff] * 3
+  data = make_png(3, 1, 3, 1, b"\x00\x20", [palette])
+  for read in (simplepng.read_png, lambda data: read_without_numpy(data)):
+    try:
+      read(data)
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+
+def test_paste():
+  rng = random.Random(0)
+  def random_pixel():
+    alpha = rng.choice([0, 0xff, rng.randrange(256)])
+    return (rng.randrange(1 << 24) << 8) | alpha
+  source = simplepng.ImageBuffer(23, 17)
+  source.data[:] = simplepng.array(simplepng.pixel_typecode, [random_pixel() for _ in range(23 * 17)])
+  dest = simplepng.ImageBuffer(30, 20)
+  dest.data[:] = simplepng.array(simplepng.pixel_typecode, [random_pixel() for _ in range(30 * 20)])
+  expected = dest.copy()
+  for y in range(10):
+    for x in range(15):
+      value = source.at(2 + x, 3 + y)
+      alpha = value & 0xff
+      if alpha == 0: continue
+      if alpha < 255: value = simplepng.alpha_blend(value, expected.at(5 + x, 4 + y))
+      expected.set(5 + x, 4 + y, value)
+  numpy = simplepng.numpy
+  for backend in (numpy, None):
+    simplepng.numpy = backend
+    try:
+      got = dest.copy()
+      got.paste(source, sx=2, sy=3, dx=5, dy=4, width=15, height=10)
+    finally:
+      simplepng.numpy = numpy
+    assert got.data == expected.data
+
+def test_flatten():
+  rng = random.Random(1)
+  # blending any pair of alphas matches alpha_blend()
+  foreground = [rng.randrange(1 << 32) for _ in range(0x2000)]
+  background = [rng.randrange(1 << 32) for _ in range(0x2000)]
+  dest = simplepng.array(simplepng.pixel_typecode, background)
+  simplepng.blend_row(dest, 0, simplepng.array(simplepng.pixel_typecode, foreground), bytes(value & 0xff for value in foreground))
+  # transparent pixels are skipped
+  assert list(dest) == [simplepng.alpha_blend(f, b) if f & 0xff else b for f, b in zip(foreground, background)]
+
+  def random_image(width, height, alphas):
+    image = simplepng.ImageBuffer(width, height)
+    image.data[:] = simplepng.array(simplepng.pixel_typecode,
+        [(rng.randrange(1 << 24) << 8) | rng.choice(alphas) for _ in range(width * height)])
+    return image
+  layers = []
+  for _ in range(8):
+    width, height = rng.randrange(4, 14), rng.randrange(4, 14)
+    rotate = rng.randrange(4)
+    alphas = rng.choice([[0xff], [0, 0xff], [0, 0xff, 0x80, 0x01]])
+    position = (rng.randrange(-5, 15), rng.randrange(-5, 12))
+    layers.append((random_image(width, height, alphas), position, rng.random() < 0.5, rotate))
+  background = random_image(16, 12, [0, 0x40, 0xff])
+  # the naive reference: blend every layer onto the whole canvas in order
+  expected = background.copy()
+  for image, (x, y), flip_h, rotate in layers:
+    image = image.copy()
+    if flip_h: image.flip_h()
+    image.rotate(rotate)
+    for iy in range(image.height):
+      for ix in range(image.width):
+        if not (0 <= x + ix < expected.width and 0 <= y + iy < expected.height): continue
+        value = image.at(ix, iy)
+        alpha = value & 0xff
+        if alpha == 0: continue
+        if alpha < 255: value = simplepng.alpha_blend(value, expected.at(x + ix, y + iy))
+        expected.set(x + ix, y + iy, value)
+  numpy = simplepng.numpy
+  for backend in (numpy, None):
+    simplepng.numpy = backend
+    try:
+      got = simplepng.flatten(layers, background=background)
+      blank = simplepng.flatten(layers[:1], (16, 12))
+    finally:
+      simplepng.numpy = numpy
+    assert got.data == expected.data
+    assert (blank.width, blank.height) == (16, 12)
+
+def test_transforms():
+  for width, height in [(1, 1), (5, 5), (7, 3), (2, 9), (300, 2)]:
+    image = simplepng.ImageBuffer(width, height)
+    image.data[:] = simplepng.array(simplepng.pixel_typecode, [(i << 8) | 0xff for i in range(width * height)])
+    def check(got, expected_width, expected_height, expected_at):
+      assert (got.width, got.height) == (expected_width, expected_height)
+      for y in range(expected_height):
+        for x in range(expected_width):
+          assert got.at(x, y) == expected_at(x, y)
+    check(image.copy(1 % width, 1 % height, width // 2, height // 2), width // 2, height // 2,
+        lambda x, y: image.at(x + 1 % width, y + 1 % height))
+    # a rect that runs off the image doesn't make a smaller copy
+    for rect in [(0, 1, width, height), (1, 0, width, height), (0, -1, width, 1), (-1, 0, 1, height)]:
+      try:
+        image.copy(*rect)
+      except IndexError:
+        pass
+      else:
+        assert False, "expected to throw"
+    check(image.flipped_h(), width, height, lambda x, y: image.at(width - 1 - x, y))
+    check(image.flipped_v(), width, height, lambda x, y: image.at(x, height - 1 - y))
+    check(image.rotated(1), height, width, lambda x, y: image.at(y, height - 1 - x))
+    check(image.rotated(-1), height, width, lambda x, y: image.at(width - 1 - y, x))
+    check(image.rotated(2), width, height, lambda x, y: image.at(width - 1 - x, height - 1 - y))
+    check(image.rotated(4), width, height, image.at)
+    # the in-place versions agree
+    other = image.copy()
+    other.rotate(3)
+    assert (other.width, other.height, other.data) == (height, width, image.rotated(-1).data)
+    other = image.copy()
+    other.flip_h()
+    other.flip_v()
+    assert other.data == image.rotated(2).data
+  # small bands exercise the tiling
+  band_size = simplepng.transpose_band_size
+  simplepng.transpose_band_size = 16
+  try:
+    banded = [image.rotated(1), image.rotated(-1)]
+  finally:
+    simplepng.transpose_band_size = band_size
+  assert [other.data for other in banded] == [image.rotated(1).data, image.rotated(-1).data]
+
+def test_read_region():
+  rng = random.Random(2)
+  numpy = simplepng.numpy
+  for name in all_schaik_decodable_names():
+    path = os.path.join(schaik_dir, name)
+    image = simplepng.read_png(path)
+    for _ in range(3):
+      width = rng.randrange(1, image.width + 1)
+      height = rng.randrange(1, image.height + 1)
+      x = rng.randrange(image.width - width + 1)
+      y = rng.randrange(image.height - height + 1)
+      expected = image.copy(x, y, width, height)
+      for backend in (numpy, None):
+        simplepng.numpy = backend
+        try:
+          got = simplepng.read_png(path, region=(x, y, width, height))
+        finally:
+          simplepng.numpy = numpy
+        assert (got.width, got.height) == (width, height), name
+        assert got.data == expected.data, name
+  # decoding stops before the missing IEND chunk
+  data = make_png(2, 3, 0, 8, b"\x00\x01\x02" * 3)[:-12]
+  assert list(simplepng.read_png(data, region=(1, 0, 1, 2)).data) == [0x020202ff] * 2
+  for region in [None, (1, 1, 2, 1), (0, 0, 0, 1)]:
+    try:
+      simplepng.read_png(data, region=region)
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+
+def test_progressive():
+  # the odd sizes have passes without any pixels
+  interlaced_names = schaik_interlaced_names + [name for name in schaik_odd_size_names if name[3] == "i"]
+  for name in interlaced_names + schaik_basic_names[:2]:
+    path = os.path.join(schaik_dir, name)
+    image = simplepng.read_png(path)
+    if name in interlaced_names:
+      blocks = simplepng.adam7_pass_blocks
+    else:
+      blocks = [(1, 1)]
+    previews = []
+    got = simplepng.read_png(path, progress=lambda *args: previews.append(args))
+    assert got.data == image.data
+    assert [pass_number for (pass_number, _) in previews] == list(range(1, len(blocks) + 1)), name
+    for (pass_number, preview), (x_scale, y_scale) in zip(previews, blocks):
+      expected = simplepng.keep_block_corners(image, x_scale, y_scale)
+      for y in range(image.height):
+        for x in range(image.width):
+          assert preview.at(x, y) == expected.at(x // x_scale, y // y_scale), name
+      reduced = simplepng.read_png(path, max_pass=pass_number)
+      assert (reduced.width, reduced.height, reduced.data) == (expected.width, expected.height, expected.data), name
+  # the missing IEND chunk is never reached when stopping early
+  with open(os.path.join(schaik_dir, schaik_interlaced_names[0]), "rb") as f:
+    data = f.read()[:-12]
+  assert simplepng.read_png(data, max_pass=6).width == 32
+  try:
+    simplepng.read_png(data)
+  except simplepng.SimplePngError:
+    pass
+  else:
+    assert False, "expected to throw"
+
+def test_png_cache():
+  paths = [os.path.join(schaik_dir, name) for name in ["basn0g08.png", "basn2c08.png", "basn6a08.png"]]
+  # each of these is 32x32 pixels, 4KiB
+  cache = simplepng.PngCache(max_bytes=2 * 32 * 32 * 4)
+  first = cache.read_png(paths[0])
+  assert (cache.hits, cache.misses) == (0, 1)
+  first.set(0, 0, 0x12345678)
+  second = cache.read_png(paths[0])
+  assert (cache.hits, cache.misses) == (1, 1)
+  assert second.data == simplepng.read_png(paths[0]).data
+  shared = cache.read_png(paths[0], shared=True)
+  assert shared is cache.read_png(paths[0], shared=True)
+  # shared images can't be changed, but their copies can
+  for change in [lambda: shared.set(0, 0, 0), lambda: shared.fill((0, 0, 1, 1), 0), lambda: shared.paste(first), lambda: shared.rotate(1)]:
+    try:
+      change()
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+  try:
+    shared.row(0)[0] = 0
+  except TypeError:
+    pass
+  else:
+    assert False, "expected to throw"
+  if simplepng.numpy != None:
+    pixels = shared.to_array()
+    try:
+      pixels.flags.writeable = True
+    except ValueError:
+      pass
+    else:
+      assert False, "expected to throw"
+  assert shared.data == second.data
+  changed = shared.copy()
+  changed.set(0, 0, 0)
+  assert type(changed) == simplepng.ImageBuffer and shared.data == second.data
+  cache.read_png(paths[1])
+  cache.read_png(paths[0])
+  # evicts paths[1], the least recently used
+  cache.read_png(paths[2])
+  assert (len(cache), cache.size, cache.evictions) == (2, 2 * 32 * 32 * 4, 1)
+  misses = cache.misses
+  cache.read_png(paths[0])
+  assert cache.misses == misses
+  cache.read_png(paths[1])
+  assert cache.misses == misses + 1
+
+  # changed files are read again
+  with tempfile.TemporaryDirectory() as temp_dir:
+    path = os.path.join(temp_dir, "layer.png")
+    shutil.copy(paths[0], path)
+    cache = simplepng.PngCache()
+    assert cache.read_png(path).data == simplepng.read_png(paths[0]).data
+    shutil.copy(paths[1], path)
+    os.utime(path, ns=(0, 0))
+    assert cache.read_png(path).data == simplepng.read_png(paths[1]).data
+    assert (cache.hits, cache.misses) == (0, 2)
+
+  # the same contents are found through any kind of source
+  cache = simplepng.PngCache(hash_contents=True)
+  with open(paths[0], "rb") as f:
+    data = f.read()
+  cache.read_png(paths[0])
+  cache.read_png(data)
+  cache.read_png(io.BytesIO(data))
+  assert (cache.hits, cache.misses, len(cache)) == (2, 1, 1)
+
+def test_stats():
+  path = os.path.join(schaik_dir, "basi6a08.png")
+  with open(path, "rb") as f:
+    data = f.read()
+  finished = []
+  stats = simplepng.PngStats(callback=finished.append)
+  image = simplepng.read_png(data, stats=stats)
+  assert finished == [stats]
+  assert (stats.bytes_in, stats.bytes_out) == (len(data), 4 * image.width * image.height)
+  info = simplepng.read_png_info(data)
+  assert sum(stats.chunk_counts.values()) == 1 + len(info.chunks)
+  assert stats.chunk_counts["IDAT"] == sum(chunk.type_code == b"IDAT" for chunk in info.chunks)
+  assert sum(stats.filter_type_histogram.values()) == 60
+  assert set(stats.seconds) == {"read", "inflate", "unfilter", "convert"}
+  assert len(list(simplepng.iter_png_rows(data, stats=stats))) == image.height
+  assert len(finished) == 2 and stats.images == 2 and stats.bytes_in == 2 * len(data)
+
+  for threads in (1, 2):
+    stats = simplepng.PngStats()
+    output = io.BytesIO()
+    simplepng.write_png(output, image, threads=threads, stats=stats)
+    assert (stats.bytes_in, stats.bytes_out) == (4 * image.width * image.height, len(output.getvalue()))
+    assert stats.chunk_counts["IEND"] == 1
+    assert stats.filter_type_histogram == {1: image.height}
+    assert set(stats.seconds) == {"choose_format", "convert", "filter", "deflate", "write"}
+    assert stats.to_dict()["bytes_out"] == stats.bytes_out
+
+def test_incremental_encoder():
+  rng = random.Random(3)
+  image = simplepng.ImageBuffer(40, 300)
+  image.data[:] = simplepng.array(simplepng.pixel_typecode, [rng.randrange(1 << 32) for _ in range(40 * 300)])
+  for filter_strategy in (1, "adaptive"):
+    encoder = simplepng.IncrementalPngEncoder(image.copy(), filter_strategy=filter_strategy, segment_size=0x1000)
+    edited = encoder.image
+    def check():
+      output = io.BytesIO()
+      encoder.write(output)
+      assert simplepng.read_png(output.getvalue()).data == edited.data
+      assert edited.dirty_rows() == []
+    check()
+    segments = list(encoder.segments)
+    edited.set(3, 100, 0x12345678)
+    edited.paste(image, sx=0, sy=0, dx=10, dy=101, width=5, height=2)
+    assert edited.dirty_rows() == [100, 101, 102]
+    check()
+    # only the segment holding rows 100-103 was compressed again
+    changed = [i for i, segment in enumerate(encoder.segments) if segment is not segments[i]]
+    assert changed == [100 // encoder.rows_per_segment]
+    # direct changes need mark_dirty()
+    edited.row(299)[0] = 0
+    edited.mark_dirty(299, 300)
+    check()
+    edited.flip_h()
+    check()
+  edited.rotate(1)
+  try:
+    encoder.write(io.BytesIO())
+  except simplepng.SimplePngError:
+    pass
+  else:
+    assert False, "expected to throw"
+  # a write() that fails partway leaves the changed rows to be done again
+  black, white = 0x000000ff, 0xffffffff
+  image = simplepng.ImageBuffer(8, 200)
+  image.fill(None, black)
+  for first_write_fails in (False, True):
+    edited = image.copy()
+    encoder = simplepng.IncrementalPngEncoder(edited, color_type=3, palette=[black, white], bit_depth=1, segment_size=0x10)
+    if not first_write_fails:
+      encoder.write(io.BytesIO())
+    edited.set(0, 10, white)
+    edited.set(0, 150, 0x12345678)
+    try:
+      encoder.write(io.BytesIO())
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+    edited.set(0, 150, white)
+    output = io.BytesIO()
+    encoder.write(output)
+    assert simplepng.read_png(output.getvalue()).data == edited.data
+
+def test_async():
+  path = os.path.join(schaik_dir, "basn6a08.png")
+  with open(path, "rb") as f:
+    data = f.read()
+  expected = simplepng.read_png(data)
+  class Writer:
+    def __init__(self):
+      self.output = bytearray()
+      self.drains = 0
+    def write(self, data):
+      self.output += data
+    async def drain(self):
+      self.drains += 1
+  async def run():
+    reader = asyncio.StreamReader()
+    async def arrive():
+      # the data arrives in small pieces while decoding is going on
+      for start in range(0, len(data), 100):
+        reader.feed_data(data[start : start + 100])
+        await asyncio.sleep(0)
+      reader.feed_eof()
+    arriving = asyncio.ensure_future(arrive())
+    image = await simplepng.read_png_async(reader, piece_size=50)
+    await arriving
+    assert image.data == expected.data
+    # the options of read_png() are passed along
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    image = await simplepng.read_png_async(reader, region=(1, 2, 3, 4))
+    assert image.data == expected.copy(1, 2, 3, 4).data
+    # errors come out of the decoder
+    reader = asyncio.StreamReader()
+    reader.feed_data(data[:-20])
+    reader.feed_eof()
+    try:
+      await simplepng.read_png_async(reader)
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+    # a slow decoder holds back the reader
+    max_queued = [0]
+    class SlowFeed(simplepng.StreamFeed):
+      def feed(self, data):
+        super().feed(data)
+        max_queued[0] = max(max_queued[0], self.pieces.qsize())
+      def read(self, size=-1):
+        time.sleep(0.001)
+        return super().read(size)
+    simplepng.StreamFeed = SlowFeed
+    try:
+      reader = asyncio.StreamReader()
+      reader.feed_data(data)
+      reader.feed_eof()
+      image = await simplepng.read_png_async(reader, piece_size=10)
+    finally:
+      simplepng.StreamFeed = SlowFeed.__bases__[0]
+    assert image.data == expected.data
+    assert 0 < max_queued[0] <= 4
+    # cancelling stops the decoder
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    reader = asyncio.StreamReader()
+    reader.feed_data(data[:100])
+    reading = asyncio.ensure_future(simplepng.read_png_async(reader, executor=executor))
+    await asyncio.sleep(0.01)
+    reading.cancel()
+    try:
+      await reading
+    except asyncio.CancelledError:
+      pass
+    else:
+      assert False, "expected to be cancelled"
+    executor.shutdown(wait=True)
+
+    writer = Writer()
+    await simplepng.write_png_async(writer, expected, filter_strategy="adaptive")
+    output = io.BytesIO()
+    simplepng.write_png(output, expected, filter_strategy="adaptive")
+    assert bytes(writer.output) == output.getvalue()
+    # one write for the signature, the IHDR chunk, and each chunk after it
+    assert writer.drains == 2 + len(simplepng.read_png_info(output.getvalue()).chunks)
+    # a writer that fails doesn't leave the encoder's error unretrieved
+    errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+    class FailingWriter(Writer):
+      def write(self, data):
+        raise ConnectionResetError()
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    try:
+      await simplepng.write_png_async(FailingWriter(), expected, executor=executor, chunk_size=100)
+    except ConnectionResetError:
+      pass
+    else:
+      assert False, "expected to throw"
+    executor.shutdown(wait=True)
+    await asyncio.sleep(0.01)
+    gc.collect()
+    assert errors == [], errors
+  asyncio.run(run())
+
+def test_compression_options():
+  for level in range(-1, 10):
+    for window_bits in range(9, 16):
+      for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_HUFFMAN_ONLY, zlib.Z_RLE, zlib.Z_FIXED):
+        expected = zlib.compressobj(level, zlib.DEFLATED, window_bits, 8, strategy).flush()[:2]
+        assert simplepng.get_zlib_header(level, window_bits, strategy) == expected
+  with open(os.path.join(schaik_expected_dir, "bas.png"), "rb") as f:
+    image = simplepng.read_png(f)
+  sizes = {}
+  for preset in ("fast", "balanced", "smallest"):
+    _, sizes[preset] = roundtrip(image, preset=preset)
+  assert sizes["smallest"] < sizes["balanced"] < sizes["fast"]
+  options = dict(compression_level=9, compression_strategy=zlib.Z_FILTERED, mem_level=9, window_bits=10, chunk_size=100)
+  out = io.BytesIO()
+  simplepng.write_png(out, image, **options)
+  assert simplepng.read_png(out.getvalue()).data == image.data
+  idat_lengths = [chunk.length for chunk in simplepng.read_png_info(out.getvalue()).chunks if chunk.type_code == b"IDAT"]
+  assert set(idat_lengths[:-1]) == {100} and 0 < idat_lengths[-1] <= 100
+  # the parallel path makes the same zlib stream header and honors the window size
+  parallel = io.BytesIO()
+  simplepng.write_png(parallel, image, threads=2, **options)
+  assert simplepng.read_png(parallel.getvalue()).data == image.data
+  # explicit options override the preset
+  _, size = roundtrip(image, preset="smallest", filter_strategy=1, compression_level=1, mem_level=8)
+  assert size == sizes["fast"]
+  # the smallest preset works with threads, and explicitly asking for brute force doesn't
+  _, size = roundtrip(image, preset="smallest", threads=2)
+  assert size < sizes["fast"]
+  bad_options_list = [dict(preset="tiny"), dict(compression_level=10), dict(compression_level=-2), dict(window_bits=8), dict(mem_level=0),
+      dict(chunk_size=0), dict(compression_strategy=99), dict(compression_strategy=99, threads=2), dict(preset="smallest", filter_strategy="brute", threads=2)]
+  for bad_options in bad_options_list:
+    out = io.BytesIO()
+    try:
+      simplepng.write_png(out, image, **bad_options)
+    except simplepng.SimplePngError:
+      pass
+    else:
+      assert False, "expected to throw"
+    # nothing is written before the options are checked
+    assert out.getvalue() == b"", bad_options
+
+def test_bulk_operations():
+  rng = random.Random(4)
+  def random_image(width, height):
+    image = simplepng.ImageBuffer(width, height)
+    image.data[:] = simplepng.array(simplepng.pixel_typecode, [rng.randrange(1 << 32) for _ in range(width * height)])
+    return image
+  def inside(image, x, y):
+    return 0 <= x < image.width and 0 <= y < image.height
+  for _ in range(200):
+    image = random_image(rng.randrange(1, 12), rng.randrange(1, 12))
+    other = random_image(rng.randrange(1, 12), rng.randrange(1, 12))
+    rect = (rng.randrange(-4, 12), rng.randrange(-4, 12), rng.randrange(0, 14), rng.randrange(0, 14))
+    expected = image.copy()
+    for y in range(rect[1], rect[1] + rect[3]):
+      for x in range(rect[0], rect[0] + rect[2]):
+        if inside(expected, x, y): expected.set(x, y, 0x12345678)
+    got = image.copy()
+    got.fill(rect, 0x12345678)
+    assert got.data == expected.data
+    x, y, width, height = got.clip_rect(rect)
+    assert got.dirty_rows() == (list(range(y, y + height)) if width > 0 else [])
+
+    sx, sy, dx, dy = [rng.randrange(-4, 8) for _ in range(4)]
+    width, height = rect[2:]
+    for source in (other, image):
+      # the same image as the source is copied as if from a snapshot
+      snapshot = source.copy()
+      expected = image.copy()
+      for y in range(height):
+        for x in range(width):
+          if inside(snapshot, sx + x, sy + y) and inside(expected, dx + x, dy + y):
+            expected.set(dx + x, dy + y, snapshot.at(sx + x, sy + y))
+      got = image.copy()
+      got.blit(got if source is image else source, sx, sy, dx, dy, width, height)
+      assert got.data == expected.data
+
+    expected = simplepng.ImageBuffer(image.width, image.height)
+    expected.fill(None, 0xff)
+    for y in range(image.height):
+      for x in range(image.width):
+        if inside(image, x - dx, y - dy): expected.set(x, y, image.at(x - dx, y - dy))
+    got = image.copy()
+    got.scroll(dx, dy, 0xff)
+    assert got.data == expected.data
+  image.clear()
+  assert set(image.data) == {0}
+
 if __name__ == "__main__":
   test_errors()
   test_dont_crash()
   test_schaik_expectations()
+  test_image_buffer_storage()
+  test_unfilter_scanline()
+  test_numpy_backend()
+  test_iter_png_rows()
+  test_png_writer()
+  test_filter_strategies()
+  test_optimize_color_type()
+  test_parallel_deflate()
+  test_batch()
+  test_read_png_info()
+  test_read_sources()
+  test_palette_index_bounds()
+  test_paste()
+  test_flatten()
+  test_transforms()
+  test_read_region()
+  test_progressive()
+  test_png_cache()
+  test_stats()
+  test_incremental_encoder()
+  test_async()
+  test_compression_options()
+  test_bulk_operations()